@@ -0,0 +1,131 @@
+"""Прогон файла запросов через конвейер main без очереди в БД
+
+Читает файл JSON lines со строками {"type", "query", "priority"[, "id"]} и отправляет запросы в ЭТРАН теми же
+построителями, воркерами, повторами и декодированием, что и сервис; результаты дописываются в выходной файл
+JSON lines (см. queue_store.FileQueue). Прерванный по Ctrl+C или упавший прогон продолжается повторным запуском
+с теми же файлами. Память не зависит от размера входного файла: читается не больше --window строк вперёд.
+С --parquet по окончании прогона результаты дополнительно переписываются в Parquet (нужен pyarrow).
+Пример: python batch.py wagons.jsonl results.jsonl --parquet results.parquet
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import config
+import main as pipeline
+from queue_store import FileQueue
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+async def run(queue: FileQueue, progress_interval: float):
+    """Запускает конвейер и останавливает его плавно, когда все строки записаны"""
+    main_task = asyncio.create_task(pipeline.main())
+    start_time, last_progress = time.monotonic(), time.monotonic()
+    while not main_task.done():
+        await asyncio.sleep(0.1)
+        if queue.finished() and not pipeline.stopping.is_set():
+            pipeline.stopping.set()
+        if time.monotonic() - last_progress >= progress_interval:
+            last_progress = time.monotonic()
+            logging.warning(
+                f"batch line={queue.line} done={queue.watermark_line + len(queue.done)} written={queue.written} "
+                f"rate={queue.written / (last_progress - start_time):.1f}/s"
+            )
+    await main_task
+
+
+def write_parquet(jsonl_path: str, parquet_path: str, row_group_size: int = 10000):
+    """Переписывает результаты из JSON lines в Parquet группами строк, не загружая файл целиком"""
+    if pyarrow is None:
+        raise RuntimeError("для --parquet нужен pyarrow")
+
+    schema = pyarrow.schema(
+        [
+            ("line", pyarrow.int64()),
+            ("id", pyarrow.string()),
+            ("type", pyarrow.int32()),
+            ("query", pyarrow.string()),
+            ("is_error", pyarrow.bool_()),
+            ("response", pyarrow.string()),
+        ]
+    )
+    with open(jsonl_path, encoding="utf8") as f, pyarrow.parquet.ParquetWriter(parquet_path, schema) as writer:
+        rows = []
+        for data in f:
+            record = json.loads(data)
+            if record["id"] is not None:
+                record["id"] = str(record["id"])
+            rows.append(record)
+            if len(rows) >= row_group_size:
+                writer.write_table(pyarrow.Table.from_pylist(rows, schema))
+                rows = []
+        if rows:
+            writer.write_table(pyarrow.Table.from_pylist(rows, schema))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="файл запросов JSON lines")
+    parser.add_argument("output", help="файл результатов JSON lines, дописывается")
+    parser.add_argument("--checkpoint", help="файл контрольной точки, по умолчанию OUTPUT.checkpoint")
+    parser.add_argument(
+        "--overwrite", action="store_true", help="начать заново, очистив OUTPUT и не глядя на контрольную точку"
+    )
+    parser.add_argument("--parquet", help="по окончании переписать результаты в этот файл Parquet")
+    parser.add_argument(
+        "--window", type=int, help="сколько строк может быть прочитано вперёд, по умолчанию 10 * QUEUE_MAXSIZE"
+    )
+    parser.add_argument("--port", type=int, default=0, help="порт HTTP-эндпоинтов, 0 - любой свободный")
+    parser.add_argument("--progress", type=float, default=10, help="интервал вывода прогресса, секунд")
+    parser.add_argument("--verbose", action="store_true", help="журнал конвейера в stderr")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO if args.verbose else logging.WARNING
+    )
+
+    # номера запросов - номера строк файла, поэтому всё, что привязано к номерам запросов в БД, отключается
+    config.QUEUE_STORE = "file"
+    config.SPOOL_PATH = None
+    config.DIGEST_PATH = None
+    config.LEASE_TIME = 0
+    config.HTTP_ENDPOINT_PORT = args.port
+    config.HEARTBEAT_PATH = os.path.join(tempfile.gettempdir(), f"batch.{os.getpid()}.heartbeat")
+
+    try:
+        queue = pipeline.file_queue = FileQueue(
+            args.input,
+            args.output,
+            args.checkpoint or f"{args.output}.checkpoint",
+            args.window or 10 * config.QUEUE_MAXSIZE,
+            args.overwrite,
+        )
+    except ValueError as e:
+        parser.error(f"{e}; --overwrite начинает прогон заново")
+    try:
+        asyncio.run(run(queue, args.progress))
+    except KeyboardInterrupt:
+        logging.warning("KeyboardInterrupt")
+    finally:
+        queue.close()
+
+    logging.warning(f"batch written={queue.written} up to line {queue.watermark_line}")
+    if not queue.finished():
+        logging.warning("batch is not finished, run again with the same files to continue")
+        sys.exit(1)
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Сравнение пикового потребления памяти и времени decode_response и decode_response_stream
+
+Каждый замер выполняется в отдельном процессе, чтобы пиковый RSS одного прогона не влиял на другой.
+Синтетический ответ тоже создаётся в отдельном процессе: пиковый RSS наследуется дочерними процессами.
+Пример: python bench_decode.py --wagons 1000 10000 50000 --type 6
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import etran_requests
+import etran_samples
+
+decoders = {
+    "tree": etran_requests.decode_response,
+    "stream": etran_requests.decode_response_stream,
+}
+
+
+def measure(decoder_name: str, path: str, result_queue):
+    """Декодирует ответ из файла path и возвращает прирост пикового RSS (КиБ) и время"""
+    with open(path, "rb") as f:
+        response = f.read()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start_time = time.perf_counter()
+    etran_response = decoders[decoder_name](response)
+    duration = time.perf_counter() - start_time
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    text = etran_response.text or ""
+    result_queue.put((peak - baseline, duration, etran_response.is_error, len(text.encode())))
+
+
+def generate(path: str, request_type: int, wagons: int, compressed: bool, fields: int, result_queue):
+    """Записывает синтетический ответ в файл path и возвращает его размер"""
+    keys = range(50000000, 50000000 + wagons)
+    response = etran_samples.make_response(request_type, keys, compressed=compressed, fields=fields)
+    with open(path, "wb") as f:
+        f.write(response)
+    result_queue.put(len(response))
+
+
+def run(target, *args):
+    """Выполняет target в отдельном процессе и возвращает положенный им в очередь результат"""
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    process = ctx.Process(target=target, args=(*args, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wagons", type=int, nargs="+", default=[1000, 10000, 50000], help="строк в ответе")
+    parser.add_argument("--fields", type=int, default=20, help="полей в строке ответа")
+    parser.add_argument("--type", type=int, default=2, choices=sorted(etran_samples.asoup_elements), help="TypeID")
+    parser.add_argument("--plain", action="store_true", help="ASOUPReply вместо ASOUP64Reply")
+    args = parser.parse_args()
+
+    print(f"{'wagons':>8} {'response':>10} {'text':>10} {'decoder':>8} {'peak RSS':>10} {'x text':>7} {'time':>8}")
+    for wagons in args.wagons:
+        with tempfile.NamedTemporaryFile(suffix=".xml", delete=False) as f:
+            pass
+        try:
+            response_len = run(generate, f.name, args.type, wagons, not args.plain, args.fields)
+            for decoder_name in decoders:
+                rss_kib, duration, is_error, text_len = run(measure, decoder_name, f.name)
+                if is_error:
+                    print(f"{wagons:>8} {response_len / 2**20:>8.1f}MB {'-':>10} {decoder_name:>8} ошибка разбора")
+                    continue
+                print(
+                    f"{wagons:>8} {response_len / 2**20:>8.1f}MB {text_len / 2**20:>8.1f}MB {decoder_name:>8} "
+                    f"{rss_kib / 2**10:>8.1f}MB {rss_kib * 2**10 / text_len:>7.1f} {duration * 1000:>6.0f}ms"
+                )
+        finally:
+            os.remove(f.name)
+
+
+if __name__ == "__main__":
+    main()
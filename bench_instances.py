@@ -0,0 +1,125 @@
+"""Проверка нескольких экземпляров main с общей очередью в SQLite и арендой запросов
+
+Запускает заглушку ЭТРАН и --instances процессов конвейера main, каждый со своим INSTANCE_ID и HTTP-портом,
+против одного файла очереди. С --kill-after первый экземпляр убивается SIGKILL через заданное число секунд,
+и его запросы должны достаться остальным после истечения аренды. Выводит распределение запросов
+по экземплярам и число обращений к ЭТРАН на запрос: больше 1 - запросы выполнялись повторно.
+Пример: python bench_instances.py --instances 3 --requests 600 --lease-time 2 --kill-after 1
+"""
+import argparse
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+import aiohttp
+
+import bench_load
+import config
+import etran_samples
+import etran_stub
+import main as pipeline
+from queue_store import SQLiteQueueStore
+
+
+def run_instance(args: argparse.Namespace, instance_id: str, stub_port: int, path: str):
+    logging.basicConfig(
+        format=f"%(asctime)s {instance_id} %(levelname)s %(message)s",
+        level=logging.INFO if args.verbose else logging.ERROR,
+    )
+    config.QUEUE_STORE = "sqlite"
+    config.QUEUE_STORE_PATH = path
+    config.INSTANCE_ID = instance_id
+    config.LEASE_TIME = args.lease_time
+    config.ETRAN_URL = f"http://127.0.0.1:{stub_port}/"
+    config.HTTP_ENDPOINT_PORT = bench_load.free_port()
+    config.HEARTBEAT_PATH = os.path.join(tempfile.gettempdir(), f"bench_instances.{instance_id}.heartbeat")
+    bench_load.apply_overrides(args.set)
+    try:
+        asyncio.run(pipeline.main())
+    except KeyboardInterrupt:
+        pass
+
+
+async def fill_queue(args: argparse.Namespace, path: str):
+    store = SQLiteQueueStore(path)
+    await store.open()
+    start_time = time.time()
+    requests = []
+    for i in range(args.requests):
+        request_type = args.types[i % len(args.types)]
+        available = start_time + i / args.rate if args.rate else start_time
+        requests.append((request_type, i % 3, etran_samples.sample_query(request_type, i + 1), available))
+    store.add_requests(requests)
+    return store, start_time
+
+
+async def stub_stats(stub_port: int) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{stub_port}/stats") as response:
+            return await response.json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instances", type=int, default=3, help="число экземпляров")
+    parser.add_argument("--requests", type=int, default=600, help="число запросов")
+    parser.add_argument(
+        "--types", type=int, nargs="+", default=[2], choices=sorted(etran_samples.request_elements.values())
+    )
+    parser.add_argument("--rate", type=float, default=0, help="запросов в секунду, 0 - все сразу")
+    parser.add_argument("--lease-time", type=float, default=5, help="срок аренды, секунд")
+    parser.add_argument("--kill-after", type=float, help="убить первый экземпляр через столько секунд после запуска")
+    parser.add_argument("--timeout", type=float, default=120, help="предельное время теста, секунд")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="параметры config")
+    parser.add_argument("--verbose", action="store_true", help="журнал экземпляров в stderr")
+    etran_stub.add_arguments(parser)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "queue.sqlite3")
+    store, start_time = asyncio.run(fill_queue(args, path))
+
+    context = multiprocessing.get_context("spawn")
+    stub_port = bench_load.free_port()
+    stub = context.Process(target=bench_load.run_stub, args=(args, stub_port), daemon=True)
+    stub.start()
+    # экземпляры запускают свои пулы декодирования, поэтому не могут быть daemon
+    instances = {
+        f"instance-{i + 1}": context.Process(target=run_instance, args=(args, f"instance-{i + 1}", stub_port, path))
+        for i in range(args.instances)
+    }
+    try:
+        bench_load.wait_for_port(stub_port)
+        for process in instances.values():
+            process.start()
+        instances_start_time = time.time()
+
+        killed = None
+        deadline = time.monotonic() + args.timeout
+        while len(completed := store.completed()) < args.requests and time.monotonic() < deadline:
+            if args.kill_after is not None and killed is None and time.time() - instances_start_time > args.kill_after:
+                killed, process = next(iter(instances.items()))
+                os.kill(process.pid, signal.SIGKILL)
+            time.sleep(0.1)
+        stats = asyncio.run(stub_stats(stub_port))
+    finally:
+        for process in [*instances.values(), stub]:
+            process.terminate()
+            process.join()
+
+    elapsed = max([row[4] for row in completed], default=time.time()) - start_time
+    etran_calls = sum(value for key, value in stats.items() if key.startswith("type_"))
+    owners = collections.Counter(row[5] for row in completed)
+    print(f"requests    {len(completed)}/{args.requests} done in {elapsed:.2f}s")
+    print(f"instances   {' '.join(f'{owner}={count}' for owner, count in sorted(owners.items(), key=str))}")
+    if killed:
+        print(f"killed      {killed} after {args.kill_after}s")
+    print(f"etran calls {etran_calls}, {etran_calls / max(len(completed), 1):.3f} per request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Нагрузочный тест конвейера main против заглушки ЭТРАН
+
+Запускает etran_stub в отдельном процессе и настоящий конвейер main (producer, batcher, воркеры, consumer,
+writers) с очередью запросов в памяти или в SQLite вместо SQL Server. Выводит пропускную способность, задержку
+от поступления запроса в очередь до записи ответа (p50/p99) и пиковый RSS. Нужен обычный config.yaml;
+параметры конвейера переопределяются через --set.
+Пример: python bench_load.py --requests 2000 --types 2 4 100 --rate 200 --dos-rate 0.02 --set WORKERS_COUNT=8
+"""
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import socket
+import tempfile
+import time
+
+import aiohttp
+import yaml
+from aiohttp import web
+
+import config
+import etran_samples
+import etran_stub
+import main as pipeline
+from queue_store import SQLiteQueueStore, memory_queue
+
+
+def run_stub(args: argparse.Namespace, port: int):
+    web.run_app(etran_stub.create_stub(args).app(), host="127.0.0.1", port=port, print=None)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Перцентиль p (0..1) отсортированного списка"""
+    return values[max(0, math.ceil(p * len(values)) - 1)] if values else float("nan")
+
+
+def apply_overrides(overrides: list[str]) -> dict:
+    """Переопределяет параметры config; WORKERS_COUNT меняет и производные от него пределы; возвращает заданные"""
+    values = {}
+    for override in overrides:
+        key, _, value = override.partition("=")
+        values[key] = yaml.safe_load(value)
+    if "WORKERS_COUNT" in values:
+        for key in ("CONCURRENCY_MIN", "CONCURRENCY_MAX", "ETRAN_POOL_SIZE"):
+            values.setdefault(key, values["WORKERS_COUNT"])
+    for key, value in values.items():
+        if not hasattr(config, key):
+            raise ValueError(f"Неизвестный параметр: {key}")
+        setattr(config, key, value)
+    return values
+
+
+async def run(args: argparse.Namespace, stub_port: int) -> dict:
+    start_time = time.time()
+    requests = []
+    for i in range(args.requests):
+        request_type = args.types[i % len(args.types)]
+        available = start_time + i / args.rate if args.rate else start_time
+        requests.append((request_type, i % 3, etran_samples.sample_query(request_type, i + 1), available))
+
+    config.QUEUE_STORE = args.store
+    if args.store == "sqlite":
+        config.QUEUE_STORE_PATH = os.path.join(tempfile.mkdtemp(), "queue.sqlite3")
+        store = SQLiteQueueStore(config.QUEUE_STORE_PATH)
+        await store.open()
+    else:
+        store = memory_queue
+        memory_queue.latency = args.db_latency
+    store.add_requests(requests)
+    # номера запросов в обоих хранилищах идут с 1 в порядке добавления
+    types = {i + 1: request[0] for i, request in enumerate(requests)}
+
+    config.ETRAN_URL = f"http://127.0.0.1:{stub_port}/"
+    config.HTTP_ENDPOINT_PORT = free_port()
+    config.HEARTBEAT_PATH = os.path.join(tempfile.gettempdir(), "bench_load.heartbeat")
+    if "ETRAN_LOGIN_CONCURRENCY" not in apply_overrides(args.set):
+        # предел на учётную запись - как у заглушки, а без него у заглушки - не ограничивает
+        config.ETRAN_LOGIN_CONCURRENCY = args.login_concurrency or config.CONCURRENCY_MAX
+
+    main_task = asyncio.create_task(pipeline.main())
+    deadline = time.monotonic() + args.timeout
+    while not main_task.done() and len(store.completed()) < args.requests and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    completed = store.completed()
+    elapsed = max([row[4] for row in completed], default=time.time()) - start_time
+
+    # остановка так же, как по Ctrl+C: без terminate CancellableSleep не даёт отменить producer
+    pipeline.db_polling_sleep.terminate = True
+    main_task.cancel()
+    await asyncio.gather(main_task, return_exceptions=True)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{config.ETRAN_URL}stats") as response:
+            stub_stats = await response.json()
+    return {
+        "completed": len(completed),
+        "errors": sum(bool(row[1]) for row in completed),
+        "response_bytes": sum(row[2] or 0 for row in completed),
+        "latencies": sorted(row[4] - row[3] for row in completed),
+        "type_latencies": {
+            request_type: sorted(row[4] - row[3] for row in completed if types[row[0]] == request_type)
+            for request_type in args.types
+        },
+        "elapsed": elapsed,
+        "budget": pipeline.byte_budget.stats(),
+        "digests": pipeline.digest_index.stats() if pipeline.digest_index is not None else None,
+        "stub_stats": stub_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="число запросов")
+    parser.add_argument(
+        "--types", type=int, nargs="+", default=[2], choices=sorted(etran_samples.request_elements.values())
+    )
+    parser.add_argument("--rate", type=float, default=0, help="запросов в секунду, 0 - все сразу")
+    parser.add_argument("--store", choices=["memory", "sqlite"], default="memory", help="хранилище очереди")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="задержка обращения к очереди в памяти, секунд")
+    parser.add_argument("--timeout", type=float, default=600, help="предельное время теста, секунд")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="параметры config")
+    parser.add_argument("--verbose", action="store_true", help="журнал main в stderr")
+    etran_stub.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO if args.verbose else logging.ERROR
+    )
+
+    stub_port = free_port()
+    stub = multiprocessing.get_context("spawn").Process(target=run_stub, args=(args, stub_port), daemon=True)
+    stub.start()
+    try:
+        wait_for_port(stub_port)
+        result = asyncio.run(run(args, stub_port))
+        # пул декодирования уже остановлен, его процессы учтены в RUSAGE_CHILDREN
+        rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    finally:
+        stub.terminate()
+        stub.join()
+
+    latencies, elapsed = result["latencies"], result["elapsed"]
+    print(f"requests    {result['completed']}/{args.requests} done, {result['errors']} errors")
+    print(f"elapsed     {elapsed:.2f}s")
+    print(
+        f"throughput  {result['completed'] / elapsed:.1f} req/s, "
+        f"{result['response_bytes'] / elapsed / 2**20:.2f} MB/s of results"
+    )
+    print(
+        f"latency     p50={percentile(latencies, 0.5) * 1000:.0f}ms p99={percentile(latencies, 0.99) * 1000:.0f}ms "
+        f"max={percentile(latencies, 1) * 1000:.0f}ms"
+    )
+    if len(args.types) > 1:
+        for request_type, type_latencies in result["type_latencies"].items():
+            print(
+                f"  type {request_type:<4}p50={percentile(type_latencies, 0.5) * 1000:.0f}ms "
+                f"p99={percentile(type_latencies, 0.99) * 1000:.0f}ms n={len(type_latencies)}"
+            )
+    print(f"peak RSS    main={rss_self / 2**10:.1f}MB decode process={rss_children / 2**10:.1f}MB")
+    budget = result["budget"]
+    print(
+        f"queue bytes peak={budget['peak'] / 2**20:.1f}MB left={budget['total']} "
+        f"pauses={budget['pauses']} budget={budget['high'] / 2**20:.1f}MB"
+    )
+    if digests := result["digests"]:
+        print(
+            f"digests     unchanged={digests['unchanged']} changed={digests['changed']} "
+            f"saved={digests['saved_bytes'] / 2**20:.1f}MB"
+        )
+    print(f"stub        {' '.join(f'{key}={value}' for key, value in sorted(result['stub_stats'].items()))}")
+
+
+if __name__ == "__main__":
+    main()
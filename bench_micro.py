@@ -0,0 +1,147 @@
+"""Микробенчмарки процессорной работы на один запрос: построители запросов, decode_response, get_code6
+
+Каждый случай прогоняется --repeat раз по столько вызовов, сколько укладывается в ~0.2 с; в результате -
+минимальное и медианное время одного вызова. --output сохраняет результаты в JSON, --compare сравнивает
+минимумы (они меньше всего зависят от фоновой нагрузки) с сохранёнными ранее и завершается с кодом 1, если
+какой-то случай замедлился больше чем на --threshold.
+Пример: python bench_micro.py --output before.json; ...; python bench_micro.py --compare before.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+from lxml import etree
+
+import etran_requests
+import etran_samples
+import utils
+
+
+def wagons(count: int) -> list[int]:
+    return [int(etran_samples.sample_query(2, i)) for i in range(count)]
+
+
+def build_cases() -> dict:
+    """Случаи: имя -> функция без аргументов"""
+    cases = {}
+
+    # построители запросов всех типов и многовагонный запрос
+    for request_type, builder in etran_requests.request_map.items():
+        query = etran_samples.sample_query(request_type, 123456)
+        cases[f"build/{request_type}"] = lambda builder=builder, query=query: builder(query)
+    query_200 = ",".join(map(str, wagons(200)))
+    cases["build/2 x200 wagons"] = lambda: etran_requests.request_map[2](query_200)
+    cases["parse_car_numbers x200"] = lambda: etran_requests.parse_car_numbers(query_200)
+
+    request_text = "<vagons>" + "".join(f'<vagon attr="&">{wagon}</vagon>' for wagon in wagons(200)) + "</vagons>"
+    cases["xml_escape 200 wagons"] = lambda: utils.xml_escape(request_text)
+
+    # значения, включая дающие контрольную цифру 10 и второй проход
+    code6_values = list(range(10000, 10100))
+    cases["get_code6 x100"] = lambda: [utils.get_code6(value) for value in code6_values]
+
+    # ответы для всех ветвей декодирования
+    responses = {
+        "asoup gzip 1 wagon": etran_samples.make_response(2, wagons(1)),
+        "asoup gzip 1000 wagons": etran_samples.make_response(2, wagons(1000)),
+        "asoup plain 1000 wagons": etran_samples.make_response(2, wagons(1000), compressed=False),
+        "asoup SPR2730 100 wagons": etran_samples.make_response(6, wagons(100)),
+        "nsi asoup": etran_samples.make_response(50, ["12345678"] * 10),
+        "nsi generic": etran_samples.make_response(100, ["50000001"]),
+        "asoup error": etran_samples.make_asoup_error_response(2, 1, "Вагон не найден"),
+        "error 504": etran_samples.make_error_response(504, "Сервис временно недоступен"),
+        "error 400 dos": etran_samples.make_error_response(400, "Дождитесь окончания предыдущего запроса"),
+        "syntax error": b"<soap:Envelope>",
+    }
+    for name, response in responses.items():
+        cases[f"decode/{name}"] = lambda response=response: etran_requests.decode_response(response)
+        cases[f"decode_stream/{name}"] = lambda response=response: etran_requests.decode_response_stream(response)
+
+    split_wagons = wagons(200)
+    split_response = etran_samples.make_response(2, split_wagons)
+    wagon_sets = [set(split_wagons[i : i + 10]) for i in range(0, len(split_wagons), 10)]
+    cases["decode_wagon_response 200 wagons / 20"] = lambda: etran_requests.decode_wagon_response(
+        split_response, wagon_sets
+    )
+    return cases
+
+
+def measure(function, repeat: int) -> dict:
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    # autorange останавливается на 0.2 с и больше; для очень быстрых случаев этого достаточно
+    times = [duration / number for duration in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "number": number,
+        "min_us": min(times) * 1e6,
+        "median_us": statistics.median(times) * 1e6,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Печатает сравнение минимумов с baseline; возвращает True, если есть замедление больше threshold"""
+    regressed = False
+    print(f"{'case':<45} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<45} {'-':>12} {result['min_us']:>10.1f}us {'new':>7}")
+            continue
+        ratio = result["min_us"] / baseline[name]["min_us"]
+        mark = ""
+        if ratio > 1 + threshold:
+            regressed, mark = True, "  SLOWER"
+        elif ratio < 1 - threshold:
+            mark = "  faster"
+        print(
+            f"{name:<45} {baseline[name]['min_us']:>10.1f}us {result['min_us']:>10.1f}us {ratio:>7.2f}{mark}"
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="только случаи, содержащие подстроку")
+    parser.add_argument("--repeat", type=int, default=5, help="повторов каждого случая")
+    parser.add_argument("--output", help="файл JSON для результатов")
+    parser.add_argument("--compare", help="файл JSON с результатами для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.15, help="допустимое замедление, доля")
+    args = parser.parse_args()
+
+    cases = {name: function for name, function in build_cases().items() if args.filter in name}
+    results = {}
+    for name, function in cases.items():
+        results[name] = measure(function, args.repeat)
+        if not args.compare:
+            print(f"{name:<45} {results[name]['median_us']:>10.1f}us (min {results[name]['min_us']:.1f}us)")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        "python": sys.version.split()[0],
+                        "lxml": ".".join(map(str, etree.LXML_VERSION)),
+                        "platform": platform.platform(),
+                        "processor": platform.processor(),
+                    },
+                    "results": results,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
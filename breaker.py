@@ -0,0 +1,90 @@
+import asyncio
+import collections
+import logging
+import time
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    """Автомат защиты от обращений к остановленному ЭТРАН
+
+    closed - запросы идут как обычно; после thresholds[класс] неудач одного класса подряд (outage - 504,
+    timeout - таймаут, error - сетевая ошибка) автомат размыкается. open - запросы не отправляются open_time
+    секунд. half_open - пропускается ровно один пробный запрос; его успех замыкает автомат и разом
+    возобновляет работу всех воркеров, неудача снова размыкает. Пробный запрос, исход которого так и не дошёл
+    до on_success или on_failure (например, воркер упал с неожиданным исключением), освобождается release,
+    чтобы пробным стал следующий запрос.
+    """
+
+    def __init__(self, thresholds: dict, open_time: float):
+        self.thresholds = thresholds
+        self.open_time = open_time
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # пробный запрос в работе: уникальный объект, выданный acquire, или None
+        self.probe = None
+        self.failures = collections.Counter()
+        # смены состояния: (из, в) -> число
+        self.transitions = collections.Counter()
+        # событие срабатывает при каждой смене состояния и заменяется новым
+        self.changed = asyncio.Event()
+
+    async def acquire(self):
+        """Дожидается разрешения на отправку запроса; для пробного запроса возвращает его метку для release"""
+        while True:
+            if self.state == CLOSED:
+                return
+
+            if self.state == OPEN:
+                if (remaining := self.opened_at + self.open_time - time.monotonic()) > 0:
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self.transition(HALF_OPEN)
+
+            if self.probe is None:
+                # этот запрос и будет пробным
+                self.probe = object()
+                return self.probe
+            await self.changed.wait()
+
+    def release(self, probe):
+        """Освобождает место пробного запроса probe, если автомат всё ещё ждёт его исхода"""
+        if probe is None or probe is not self.probe:
+            return
+        logging.warning("circuit breaker probe finished without an outcome")
+        self.probe = None
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def on_success(self):
+        self.failures.clear()
+        if self.state != CLOSED:
+            self.transition(CLOSED)
+
+    def on_failure(self, kind: str):
+        self.failures[kind] += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures[kind] >= self.thresholds[kind]):
+            self.transition(OPEN, kind)
+
+    def transition(self, state: str, reason: str = None):
+        logging.warning(f"circuit breaker {self.state} -> {state}{f' because of {reason}' if reason else ''}")
+        self.transitions[(self.state, state)] += 1
+        self.state = state
+        self.probe = None
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            self.failures.clear()
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "open_for": max(0.0, self.opened_at + self.open_time - time.monotonic()) if self.state == OPEN else 0.0,
+            "failures": dict(self.failures),
+            "transitions": {f"{old}->{new}": count for (old, new), count in self.transitions.items()},
+        }
@@ -0,0 +1,58 @@
+import asyncio
+import collections
+import logging
+
+
+class ByteBudget:
+    """Учёт байтов, которые держат очереди ответов и результатов, с остановкой приёма по двум порогам
+
+    Когда всего учтено больше high байт, wait() не пускает воркеры за новыми запросами, пока объём не опустится
+    до low; так всплеск больших ответов или медленная БД не раздувают память процесса. Уже отправленные запросы
+    завершаются, поэтому объём может превысить high на размер ответов, пришедших после остановки. С high = 0
+    только считает.
+    """
+
+    def __init__(self, high: int, low: int = None):
+        self.high = high
+        self.low = low if low is not None else int(high * 0.8)
+        # байты по очередям: out - сырые ответы ЭТРАН, db - тексты результатов
+        self.used = collections.Counter()
+        self.total = 0
+        self.peak = 0
+        self.paused = False
+        self.pauses = 0
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+
+    def add(self, queue: str, size: int):
+        self.used[queue] += size
+        self.total += size
+        self.peak = max(self.peak, self.total)
+        if self.high and not self.paused and self.total > self.high:
+            logging.info(f"byte budget exceeded: {self.total} > {self.high}, pausing workers")
+            self.paused = True
+            self.pauses += 1
+            self.resumed.clear()
+
+    def release(self, queue: str, size: int):
+        self.used[queue] -= size
+        self.total -= size
+        if self.paused and self.total <= self.low:
+            logging.info(f"byte budget recovered: {self.total} <= {self.low}, resuming workers")
+            self.paused = False
+            self.resumed.set()
+
+    async def wait(self):
+        """Дожидается, пока объём не опустится до нижнего порога, если верхний был превышен"""
+        await self.resumed.wait()
+
+    def stats(self) -> dict:
+        return {
+            "high": self.high,
+            "low": self.low,
+            "total": self.total,
+            "peak": self.peak,
+            "paused": self.paused,
+            "pauses": self.pauses,
+            **{f"{queue}_bytes": size for queue, size in self.used.items()},
+        }
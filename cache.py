@@ -0,0 +1,131 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """LRU-кэш ответов на справочные запросы со сроком жизни по типам и необязательным хранением на диске
+
+    Ключ - тип запроса и хэш сформированного тела запроса, т.е. запроса после нормализации его построителем.
+    Кэшируются только типы, для которых задан срок жизни. Обращения к файлу выполняются в отдельном потоке,
+    как в spool, чтобы запись многомегабайтных ответов не останавливала цикл событий.
+    """
+
+    def __init__(self, ttl: dict, max_entries: int, path: str = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (тип, хэш) -> (срок годности, текст ответа), в порядке последнего обращения
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.db = None
+        self.executor = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(type INTEGER, key TEXT, expires REAL, text TEXT, PRIMARY KEY (type, key))"
+            )
+            deleted = self.db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),)).rowcount
+            self.db.commit()
+            logging.info(f"cache opened {path}, {deleted} expired entries removed")
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache")
+
+    def enabled(self, request_type: int) -> bool:
+        return request_type in self.ttl
+
+    @staticmethod
+    def digest(request_body: str) -> str:
+        return hashlib.sha256(request_body.encode()).hexdigest()
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def get(self, request_type: int, request_body: str):
+        """Возвращает текст ответа из кэша или None"""
+        if not self.enabled(request_type):
+            return None
+
+        now = time.time()
+        key = (request_type, self.digest(request_body))
+        if (entry := self.entries.get(key)) is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+
+        if self.db is not None:
+            row = await self.run(self.select, key, now)
+            if row is not None:
+                self.store(key, row[0], row[1])
+                self.hits += 1
+                return row[1]
+
+        self.misses += 1
+        return None
+
+    def select(self, key: tuple, now: float):
+        return self.db.execute(
+            "SELECT expires, text FROM cache WHERE type = ? AND key = ? AND expires > ?", (*key, now)
+        ).fetchone()
+
+    async def put(self, request_type: int, request_body: str, text: str):
+        if not self.enabled(request_type):
+            return
+
+        key = (request_type, self.digest(request_body))
+        expires = time.time() + self.ttl[request_type]
+        self.store(key, expires, text)
+        if self.db is not None:
+            await self.run(self.insert, key, expires, text)
+
+    def insert(self, key: tuple, expires: float, text: str):
+        self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (*key, expires, text))
+        self.db.commit()
+
+    def store(self, key: tuple, expires: float, text: str):
+        """Помещает запись в память, вытесняя самые давно использованные"""
+        self.entries[key] = (expires, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def invalidate(self, request_type: int = None, request_body: str = None) -> int:
+        """Удаляет запись, все записи типа или весь кэш; возвращает количество удалённых записей"""
+        if request_body is not None:
+            keys = [(request_type, self.digest(request_body))]
+            where, params = "type = ? AND key = ?", keys[0]
+        elif request_type is not None:
+            keys = [key for key in self.entries if key[0] == request_type]
+            where, params = "type = ?", (request_type,)
+        else:
+            keys = list(self.entries)
+            where, params = "1 = 1", ()
+
+        count = sum(self.entries.pop(key, None) is not None for key in keys)
+        if self.db is not None:
+            count = max(count, await self.run(self.delete, where, params))
+        return count
+
+    def delete(self, where: str, params: tuple) -> int:
+        count = self.db.execute(f"DELETE FROM cache WHERE {where}", params).rowcount
+        self.db.commit()
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,3 +1,6 @@
+import os
+import socket
+
 import yaml
 
 with open("config.yaml", encoding="utf8") as f:
@@ -18,17 +21,99 @@ SERVICE_NAME = config["app"]["SERVICE_NAME"]
 HTTP_ENDPOINT_PORT = config["app"]["HTTP_ENDPOINT_PORT"]
 DEBUG = config["app"]["DEBUG"]
 
+# пул декодирования ответов: "process" или "thread"
+DECODE_EXECUTOR = config["app"].get("DECODE_EXECUTOR", "process")
+DECODE_WORKERS = config["app"].get("DECODE_WORKERS") or os.cpu_count()
+# потоковое декодирование: меньше памяти на больших ответах ценой процессорного времени
+DECODE_STREAMING = config["app"].get("DECODE_STREAMING", False)
+# сколько раз пробовать декодировать ответ, прежде чем записать его ошибкой
+DECODE_ATTEMPTS = config["app"].get("DECODE_ATTEMPTS", 3)
+# пределы адаптивного числа параллельных запросов к ЭТРАН (по умолчанию - ровно WORKERS_COUNT),
+# коэффициент его уменьшения при ошибках и рост задержки типа запроса относительно обычной для него,
+# при котором предел перестаёт расти
+CONCURRENCY_MIN = config["app"].get("CONCURRENCY_MIN", WORKERS_COUNT)
+CONCURRENCY_MAX = config["app"].get("CONCURRENCY_MAX", WORKERS_COUNT)
+CONCURRENCY_BACKOFF = config["app"].get("CONCURRENCY_BACKOFF", 0.7)
+CONCURRENCY_LATENCY_TOLERANCE = config["app"].get("CONCURRENCY_LATENCY_TOLERANCE", 2.0)
+# планировщик очереди запросов к ЭТРАН по типам (см. scheduler.py): веса, пределы одновременно выполняемых
+# запросов и сроки ожидания в секундах; aging - на сколько улучшается приоритет за секунду ожидания
+SCHEDULER_WEIGHTS = {int(k): v for k, v in config.get("scheduler", {}).get("weights", {}).items()}
+SCHEDULER_CAPS = {int(k): v for k, v in config.get("scheduler", {}).get("caps", {}).items()}
+SCHEDULER_DEADLINES = {int(k): v for k, v in config.get("scheduler", {}).get("deadlines", {}).items()}
+SCHEDULER_AGING = config.get("scheduler", {}).get("aging", 0)
+# индекс хэшей записанных ответов (см. digests.py): файл SQLite (без него ответы всегда пишутся полностью),
+# типы запросов, для которых неизменившийся ответ пишется маркером (по умолчанию все), и через сколько секунд
+# полный текст пишется снова (0 - никогда)
+DIGEST_PATH = config.get("digest", {}).get("path")
+DIGEST_TYPES = config.get("digest", {}).get("types")
+DIGEST_MAX_AGE = config.get("digest", {}).get("max_age", 86400)
+# трассировка запросов (см. tracing.py): файл JSON lines для завершённых трасс (без него трассы не пишутся)
+# и пороги медленных запросов в секундах по типам и для остальных типов (без порога журнал не ведётся)
+TRACE_PATH = config.get("trace", {}).get("path")
+TRACE_SLOW = {int(k): v for k, v in config.get("trace", {}).get("slow", {}).items()}
+TRACE_SLOW_DEFAULT = config.get("trace", {}).get("slow_default")
+# автомат защиты: сколько неудач подряд каждого класса размыкают его и на сколько секунд
+BREAKER_THRESHOLDS = {"outage": 1, "timeout": 5, "error": 3, **config["app"].get("BREAKER_THRESHOLDS", {})}
+BREAKER_OPEN_TIME = config["app"].get("BREAKER_OPEN_TIME", SLEEP_ON_DOS_MAX)
+# объединение запросов по вагонам: максимум вагонов в запросе (0 - не объединять) и время набора в секундах
+WAGON_BATCH_SIZE = config["app"].get("WAGON_BATCH_SIZE", 0)
+WAGON_BATCH_WAIT = config["app"].get("WAGON_BATCH_WAIT", 0.5)
+# сколько байт могут занимать в памяти ответы ЭТРАН и результаты до остановки воркеров (0 - без предела)
+# и ниже какого объёма воркеры возобновляют работу (по умолчанию - 80% от BYTE_BUDGET)
+BYTE_BUDGET = config["app"].get("BYTE_BUDGET", 0)
+BYTE_BUDGET_LOW = config["app"].get("BYTE_BUDGET_LOW")
+# сроки плавной остановки по SIGINT/SIGTERM, секунд: на ожидание отправленных запросов и на запись полученных ответов
+DRAIN_TIMEOUT = config["app"].get("DRAIN_TIMEOUT", 30)
+# запись результатов в БД: число соединений, размер пачки и время её набора в секундах
+DB_WRITERS = config["app"].get("DB_WRITERS", 2)
+DB_BATCH_SIZE = config["app"].get("DB_BATCH_SIZE", 50)
+DB_BATCH_TIMEOUT = config["app"].get("DB_BATCH_TIMEOUT", 0.2)
+
 DB_DRIVER = config["db"]["driver"]
 DB_SERVER = config["db"]["server"]
 DB_USER = config["db"]["user"]
 DB_PASSWORD = config["db"]["password"]
 DB_DATABASE = config["db"]["database"]
 DB_ENCRYPT = config["db"]["encrypt"]
+# процедура пакетной записи результатов с табличным параметром @Responses; без неё - executemany
+DB_BULK_PROCEDURE = config["db"].get("bulk_procedure")
+# хранилище очереди запросов: "odbc" - SQL Server, "sqlite" - файл path, "memory" - память процесса
+QUEUE_STORE = config["db"].get("store", "odbc")
+QUEUE_STORE_PATH = config["db"].get("path", "queue.sqlite3")
+# несколько экземпляров сервиса с одной очередью: срок аренды взятых запросов в секундах (0 - один экземпляр,
+# при запуске сбрасываются все взятые запросы) и имя экземпляра, уникальное и постоянное между перезапусками
+LEASE_TIME = config["db"].get("lease_time", 0)
+INSTANCE_ID = config["db"].get("instance_id") or socket.gethostname()
 DB_CONNECTION_STRING = f"DRIVER={DB_DRIVER};SERVER={DB_SERVER};DATABASE={DB_DATABASE};UID={DB_USER};PWD={DB_PASSWORD}"\
                        f"{';Encrypt=YES;TrustServerCertificate=YES' if DB_ENCRYPT else ''}"
 
-ETRAN_LOGIN = config["etran"]["login"]
-ETRAN_PASSWORD = config["etran"]["password"]
+# срок жизни кэшированных ответов в секундах по типам запросов; типы без срока не кэшируются
+CACHE_TTL = {int(k): v for k, v in config.get("cache", {}).get("ttl", {}).items()}
+CACHE_MAX_ENTRIES = config.get("cache", {}).get("max_entries", 10000)
+CACHE_PATH = config.get("cache", {}).get("path")
+
+# журнал готовых, но не записанных в БД результатов (см. spool.py); без path не ведётся
+SPOOL_PATH = config.get("spool", {}).get("path")
+# сколько результатов очередь записи держит в памяти целиком; сверх этого тексты остаются только в журнале
+SPOOL_MEMORY_LIMIT = config.get("spool", {}).get("memory_limit", 1000)
+
+# учётные записи ЭТРАН: список {login, password[, concurrency]}; без него - одна запись login/password.
+# Первая запись используется построителями запросов, при отправке LoginPool подставляет выбранную
+ETRAN_CREDENTIALS = config["etran"].get("credentials") or [
+    {"login": config["etran"]["login"], "password": config["etran"]["password"]}
+]
+ETRAN_LOGIN = ETRAN_CREDENTIALS[0]["login"]
+ETRAN_PASSWORD = ETRAN_CREDENTIALS[0]["password"]
 ETRAN_URL = config["etran"]["url"]
 ETRAN_HEADERS = config["etran"]["headers"]
 ETRAN_GZIP = config["etran"]["gzip"]
+# общий для всех воркеров пул соединений с ЭТРАН: размер (по умолчанию - по числу воркеров), предел на хост
+# (0 - без предела) и сколько секунд держать простаивающее соединение открытым
+ETRAN_POOL_SIZE = config["etran"].get("pool_size", CONCURRENCY_MAX)
+ETRAN_POOL_PER_HOST = config["etran"].get("pool_per_host", 0)
+ETRAN_KEEPALIVE_TIMEOUT = config["etran"].get("keepalive_timeout", 60)
+# сжатие HTTP-ответов; "identity" - без сжатия
+ETRAN_ACCEPT_ENCODING = config["etran"].get("accept_encoding", "gzip, deflate")
+# предел параллельных запросов на учётную запись, если не задан у самой записи; ЭТРАН отвечает отказом
+# в обслуживании на запрос, отправленный до ответа на предыдущий, поэтому по умолчанию - один
+ETRAN_LOGIN_CONCURRENCY = config["etran"].get("login_concurrency", 1)
@@ -0,0 +1,34 @@
+"""Минимальный config.yaml для тестов: config читает его из текущего каталога при импорте"""
+import os
+import tempfile
+
+TEST_CONFIG = """
+app:
+  QUEUE_MAXSIZE: 10
+  WORKERS_COUNT: 2
+  SLEEP_ON_DISCONNECT: 1
+  SLEEP_ON_DOS: 1
+  SLEEP_ON_DOS_MAX: 5
+  DB_POLLING_INTERVAL: 1
+  DB_QUERYING_INTERVAL: 0.1
+  REQUEST_TIMEOUT: 5
+  HEARTBEAT_INTERVAL: 5
+  HEARTBEAT_MULTIPLIER: 3
+  HEARTBEAT_PATH: heartbeat
+  SERVICE_NAME: rzdb-etran
+  HTTP_ENDPOINT_PORT: 0
+  DEBUG: false
+db: {driver: test, server: test, user: test, password: test, database: test, encrypt: false}
+etran: {login: test, password: test, url: "http://127.0.0.1/", headers: {}, gzip: true}
+"""
+
+if not os.path.exists("config.yaml"):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as config_dir:
+        with open(os.path.join(config_dir, "config.yaml"), "w", encoding="utf8") as f:
+            f.write(TEST_CONFIG)
+        os.chdir(config_dir)
+        try:
+            import config  # noqa: F401
+        finally:
+            os.chdir(cwd)
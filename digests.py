@@ -0,0 +1,108 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import sqlite3
+import time
+
+# текст, записываемый в БД вместо ответа, совпадающего с ответом запроса request_id
+UNCHANGED_MARKER = '<unchanged id="{request_id}"/>'
+
+
+def digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class DigestIndex:
+    """Хэши последних записанных в БД ответов по запросам в файле SQLite
+
+    Ключ - тип запроса и хэш сформированного тела запроса, как у кэша ответов. Если ответ на повторный запрос
+    совпадает с последним записанным полным ответом, в БД вместо текста пишется UNCHANGED_MARKER с номером
+    запроса, у которого этот текст записан. Полный текст пишется снова, если он записан раньше чем max_age
+    секунд назад, чтобы маркеры не ссылались на строки, которые могли удалить из БД. Хэширование и обращения
+    к SQLite выполняются в отдельном потоке, как в spool.
+    """
+
+    def __init__(self, path: str, types: list = None, max_age: float = 0):
+        self.types = set(types) if types is not None else None
+        self.max_age = max_age
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS digests (TypeID INTEGER, Key BLOB, Digest BLOB, RequestID INTEGER, "
+            "Written REAL, PRIMARY KEY (TypeID, Key)) WITHOUT ROWID"
+        )
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="digests")
+        self.unchanged = 0
+        self.changed = 0
+        self.saved_bytes = 0
+        logging.info(f"digest index opened {path}")
+
+    def enabled(self, request_type: int) -> bool:
+        return self.types is None or request_type in self.types
+
+    @staticmethod
+    def key(request_body: str) -> bytes:
+        return digest(request_body)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def check(self, results: list):
+        """Заполняет у результатов digest и same_as - номер запроса с таким же записанным ответом или None
+
+        Проверяются успешные результаты с заданным телом запроса (request_body) включённых типов.
+        """
+        await self.run(self.lookup, results)
+
+    def lookup(self, results: list):
+        checked = [
+            result
+            for result in results
+            if not result.is_error and result.request_body is not None and self.enabled(result.request_type)
+        ]
+        min_written = time.time() - self.max_age if self.max_age else 0
+        for result in checked:
+            result.digest = digest(result.text)
+            entry = self.db.execute(
+                "SELECT Digest, RequestID, Written FROM digests WHERE TypeID = ? AND Key = ?",
+                (result.request_type, self.key(result.request_body)),
+            ).fetchone()
+            if (
+                entry is not None
+                and entry[0] == result.digest
+                and entry[1] != result.request_id
+                and entry[2] >= min_written
+            ):
+                result.same_as = entry[1]
+                self.unchanged += 1
+                self.saved_bytes += len(result.text)
+            else:
+                result.same_as = None
+                self.changed += 1
+
+    async def update(self, results: list):
+        """Запоминает записанные в БД полные ответы"""
+        await self.run(self.save, results)
+
+    def save(self, results: list):
+        rows = [
+            (result.request_type, self.key(result.request_body), result.digest, result.request_id)
+            for result in results
+            if result.digest is not None and result.same_as is None
+        ]
+        if not rows:
+            return
+        now = time.time()
+        self.db.execute("BEGIN")
+        self.db.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)", [(*row, now) for row in rows])
+        self.db.execute("COMMIT")
+
+    def stats(self) -> dict:
+        return {
+            "entries": self.db.execute("SELECT COUNT(*) FROM digests").fetchone()[0],
+            "unchanged": self.unchanged,
+            "changed": self.changed,
+            "saved_bytes": self.saved_bytes,
+        }
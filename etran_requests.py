@@ -1,6 +1,9 @@
 import base64
+import copy
 import gzip
 import re
+import string
+import zlib
 from dataclasses import dataclass
 
 from lxml import etree
@@ -8,18 +11,31 @@ from lxml import etree
 import config
 import utils
 
-etran_template = rf"""
+
+def envelope_template(login: str, password: str) -> str:
+    """SOAP-конверт запроса к ЭТРАН от имени учётной записи; {0} - внутренний XML запроса"""
+    return rf"""
 <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:sys="SysEtranInt">
 <soapenv:Body>
     <sys:GetBlock>
-        <Login>{config.ETRAN_LOGIN}</Login>
-        <Password>{config.ETRAN_PASSWORD}</Password>
+        <Login>{login}</Login>
+        <Password>{password}</Password>
         <Text>{{0}}</Text>
     </sys:GetBlock>
 </soapenv:Body>
 </soapenv:Envelope>
 """
 
+
+def envelope_head(login: str, password: str) -> str:
+    """Начало конверта до внутреннего XML запроса, включая учётные данные"""
+    return envelope_template(login, password).split("{0}")[0]
+
+
+# построители формируют запросы от имени учётной записи по умолчанию, LoginPool при отправке подставляет нужную
+etran_template = envelope_template(config.ETRAN_LOGIN, config.ETRAN_PASSWORD)
+default_envelope_head = envelope_head(config.ETRAN_LOGIN, config.ETRAN_PASSWORD)
+
 train_index_pattern1 = re.compile(r"(\d{5})(?:\D)(\d{3})(?:\D)(\d{5})")
 train_index_pattern2 = re.compile(r"(?:\d{15})")
 xmlns_pattern = re.compile(r"(?:<root.*?>)")
@@ -34,6 +50,8 @@ carpart_pattern = re.compile(r"(\d{1})-(\d{1,10})-(\d{1,4})-(\d{4})")
 class ETRANResponse:
     is_error: bool
     text: str
+    # ответы для исходных запросов, если запрос был объединённым
+    parts: list[str] = None
 
 
 def decode_response(response: bytes) -> ETRANResponse:
@@ -83,97 +101,246 @@ def decode_response(response: bytes) -> ETRANResponse:
         return ETRANResponse(is_error, text)
 
 
-def request_SPP4700(query: str) -> str:
-    """Работа с поездом"""
-    request_template = rf"""
-<GetInform>{"<UseGZIPBinary>1</UseGZIPBinary>" if config.ETRAN_GZIP else ""}
-<ns0:getReferenceSPP4700 xmlns:ns0="http://service.siw.pktbcki.rzd/">
-<ns0:ReferenceSPP4700Request>
-<idUser>0</idUser>
-<indexPoezd>{{0}}</indexPoezd>
-</ns0:ReferenceSPP4700Request>
-</ns0:getReferenceSPP4700>
-</GetInform>
-    """
+# размер порции, которой данные передаются между уровнями потокового разбора
+STREAM_CHUNK_SIZE = 64 * 1024
 
-    if m := train_index_pattern1.fullmatch(query):
-        train_index = f"{utils.get_code6(int(m.group(1)))}{m.group(2)}{utils.get_code6(int(m.group(3)))}"
-    elif train_index_pattern2.fullmatch(query):
-        train_index = query
-    else:
-        raise ValueError(f"Некорректный формат индекса поезда: {query}")
 
-    return etran_template.format(utils.xml_escape(request_template.format(train_index)))
+def decode_response_stream(response: bytes) -> ETRANResponse:
+    """Потоковый вариант decode_response, не держащий в памяти промежуточные документы целиком"""
+    try:
+        reply = _ReplyStream()
+        parser = etree.XMLParser(target=_EnvelopeTarget(reply))
+        for i in range(0, len(response), STREAM_CHUNK_SIZE):
+            parser.feed(response[i : i + STREAM_CHUNK_SIZE])
+        parser.close()
+        return reply.result()
+    except (etree.XMLSyntaxError, ValueError, zlib.error) as e:
+        return ETRANResponse(True, repr(e))
 
 
-def request_SPV4659(query: str) -> str:
-    """Техническое состояние вагонов"""
-    request_template = rf"""
-<GetInform>{"<UseGZIPBinary>1</UseGZIPBinary>" if config.ETRAN_GZIP else ""}
-<ns0:getReferenceSPV4659 xmlns:ns0="http://service.siw.pktbcki.rzd/">
-<ns0:ReferenceSPV4659Request>
-<idUser>0</idUser>
-<vagons>{{0}}</vagons>
-</ns0:ReferenceSPV4659Request>
-</ns0:getReferenceSPV4659>
-</GetInform>
-    """
-    values = set()
+class _EnvelopeTarget:
+    """Цель парсера внешнего конверта: передаёт текст Envelope/Body/GetBlockResponse/Text по частям"""
 
-    for value in map(str.strip, query.split(",")):
-        if not len(value):
-            pass
-        elif carnumber_pattern.fullmatch(value):
-            values.add(int(value))
-        else:
-            raise ValueError(f"Некорректный номер вагона: {value}")
+    def __init__(self, reply):
+        self.reply = reply
+        self.depth = 0
+        self.in_text = False
 
-    if len(values):
-        return etran_template.format(
-            utils.xml_escape(request_template.format("".join(f"<vagon>{value}</vagon>" for value in values)))
-        )
-    else:
-        raise ValueError(f"Некорректный запрос: {query}")
+    def start(self, tag, attrib):
+        self.in_text = self.depth == 3 and tag == "Text"
+        self.depth += 1
 
+    def end(self, tag):
+        self.depth -= 1
+        if self.in_text:
+            self.in_text = False
+            self.reply.finish()
 
-def request_SPV4716(query: str) -> str:
-    """Текущее состояние детали"""
-    request_template = rf"""
-<GetInform>{"<UseGZIPBinary>1</UseGZIPBinary>" if config.ETRAN_GZIP else ""}
-<ns0:getReferenceSPV4716 xmlns:ns0="http://service.siw.pktbcki.rzd/">
-<ns0:ReferenceSPV4716Request>
-<idUser>0</idUser>
-<tipDet>{{0}}</tipDet>
-<zavod>{{1}}</zavod>
-<nomDet>{{2}}</nomDet>
-<godPost>{{3}}</godPost>
-</ns0:ReferenceSPV4716Request>
-</ns0:getReferenceSPV4716>
-</GetInform>
-    """
+    def data(self, data):
+        if self.in_text:
+            self.reply.feed(data)
 
-    if m := carpart_pattern.fullmatch(query):
-        part_type, part_number, part_factory, part_year = m.group(1, 2, 3, 4)
-    else:
-        raise ValueError(f"Некорректный формат номера детали: {query}")
+    def close(self):
+        pass
 
-    return etran_template.format(
-        utils.xml_escape(request_template.format(part_type, part_factory, part_number, part_year))
-    )
 
+class _ChunkBuffer:
+    """Копит мелкие куски текста, которые выдаёт парсер, и отдаёт их порциями по STREAM_CHUNK_SIZE"""
 
-def request_SPV4650(query: str) -> str:
-    """Пробеги вагонов (SPV4650)"""
-    request_template = rf"""
-<GetInform>{"<UseGZIPBinary>1</UseGZIPBinary>" if config.ETRAN_GZIP else ""}
-<ns0:getReferenceSPV4650 xmlns:ns0="http://service.siw.pktbcki.rzd/">
-<ns0:ReferenceSPV4650Request>
-<idUser>0</idUser>
-<vagons>{{0}}</vagons>
-</ns0:ReferenceSPV4650Request>
-</ns0:getReferenceSPV4650>
-</GetInform>
-    """
+    def __init__(self):
+        self.pending = []
+        self.pending_size = 0
+
+    def feed(self, text: str):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= STREAM_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self, final=False):
+        text = "".join(self.pending)
+        self.pending.clear()
+        self.pending_size = 0
+        self.process(text, final)
+
+    def process(self, text: str, final: bool):
+        raise NotImplementedError
+
+
+class _ReplyStream(_ChunkBuffer):
+    """Потоковый разбор внутреннего XML (GetInformReply, error и т.д.)"""
+
+    def __init__(self):
+        super().__init__()
+        # во внутреннем XML ошибочно указывается кодировка Windows-1251
+        self.parser = etree.XMLParser(target=self, encoding="UTF-8")
+        self.tag = None
+        self.streamed = False
+        self.depth = 0
+        self.error = {}
+        self.field = None
+        self.asoup = None
+        # прочие ответы (getNSIReply, getOrgPassportReply, etc.) невелики и разбираются целиком
+        self.raw = []
+        self.text = None
+
+    def process(self, text, final):
+        chunk = text.encode()
+        if not self.streamed:
+            self.raw.append(chunk)
+        self.parser.feed(chunk)
+        if final:
+            self.parser.close()
+
+    def finish(self):
+        self.flush(final=True)
+
+    def start(self, tag, attrib):
+        if self.depth == 0:
+            self.tag = tag
+            self.streamed = tag in {"error", "GetInformReply", "GetInformNSIReply"}
+            if self.streamed:
+                self.raw.clear()
+        elif self.depth == 1:
+            if self.tag == "error" and tag in {"errorStatusCode", "errorMessage"}:
+                self.error[tag] = attrib.get("value")
+            elif self.tag in {"GetInformReply", "GetInformNSIReply"} and tag in {"ASOUPReply", "ASOUP64Reply"}:
+                self.field = tag
+        self.depth += 1
+
+    def end(self, tag):
+        self.depth -= 1
+        if self.depth == 1:
+            self.field = None
+
+    def data(self, data):
+        if self.field is None:
+            return
+        if self.asoup is None:
+            self.asoup = _ASOUPStream(self.field)
+        if self.asoup.field == self.field:
+            self.asoup.feed(data)
+
+    def close(self):
+        if self.tag is not None and not self.streamed:
+            root = etree.fromstring(b"".join(self.raw), etree.XMLParser(encoding="UTF-8"))
+            self.text = etree.tostring(root, encoding="UTF-8").decode()
+            self.raw.clear()
+        elif self.asoup is not None:
+            self.asoup.flush(final=True)
+
+    def result(self) -> ETRANResponse:
+        if self.tag is None:
+            raise ValueError("Не найден текст ответа")
+        elif self.tag == "error":
+            return ETRANResponse(True, f"{self.error.get('errorStatusCode')} {self.error.get('errorMessage')}")
+        elif not self.streamed:
+            return ETRANResponse(False, self.text)
+        elif self.asoup is None:
+            raise ValueError("Пустой ответ АСОУП")
+        else:
+            return self.asoup.result()
+
+
+class _ASOUPStream(_ChunkBuffer):
+    """Потоковый разбор ответа АСОУП: полезная нагрузка сериализуется по мере поступления"""
+
+    def __init__(self, field: str):
+        super().__init__()
+        # ASOUPReply или ASOUP64Reply
+        self.field = field
+        self.parser = etree.XMLPullParser(events=("start", "end"), encoding="UTF-8")
+        self.gunzip = zlib.decompressobj(zlib.MAX_WBITS | 16) if field == "ASOUP64Reply" else None
+        self.b64_tail = ""
+        self.depth = 0
+        # Envelope/Body/getReferenceSPXXXXXResponse/return
+        self.ret = None
+        # сериализуемый элемент: referenceSPXXXXX или сам return, и глубина его дочерних элементов
+        self.root = None
+        self.child_depth = 5
+        self.root_text_written = False
+        # временный родитель без namespace'ов, чтобы lxml не дописывал их в каждый дочерний элемент
+        self.holder = etree.Element("root")
+        # результат копится в UTF-8: для кириллицы это вдвое компактнее str
+        self.out = bytearray(b"<root>")
+        self.fields = {}
+
+    def process(self, text, final):
+        if self.gunzip is None:
+            data = text.encode()
+        else:
+            text = self.b64_tail + "".join(text.split())
+            n = len(text) if final else len(text) - len(text) % 4
+            self.b64_tail = text[n:]
+            data = self.gunzip.decompress(base64.b64decode(text[:n]))
+            if final:
+                data += self.gunzip.flush()
+
+        self.parser.feed(data)
+        if final:
+            self.parser.close()
+
+        for event, el in self.parser.read_events():
+            # глубину проверяем раньше всего: событий от вложенных элементов строк справки большинство
+            if event == "start":
+                depth = self.depth
+                self.depth += 1
+                if depth > self.child_depth:
+                    continue
+                if depth == 3 and self.ret is None:
+                    self.ret = el
+                elif depth == 4 and self.root is None:
+                    if el.tag == "referenceEDOK_SPR2730_1":
+                        self.root, self.child_depth = self.ret, 4
+                    else:
+                        self.root, self.child_depth = el, 5
+                if depth == self.child_depth:
+                    self.drain(until=el)
+            else:
+                self.depth -= 1
+                depth = self.depth
+                if depth > self.child_depth:
+                    continue
+                if depth == 4 and el.tag in {"returnCode", "errorMessage"}:
+                    self.fields[el.tag] = el.text or ""
+                if self.root is None:
+                    pass
+                elif el is self.root:
+                    self.drain(until=None)
+                    # как и в decode_response, пустой элемент превращается в "<root>"
+                    if len(self.out) > len(b"<root>"):
+                        self.out += b"</root>"
+                elif depth == self.child_depth - 2 and self.root.tail:
+                    self.out += self.escape(self.root.tail)
+
+    def drain(self, until):
+        """Сериализует и удаляет из дерева уже разобранные дочерние элементы root"""
+        if not self.root_text_written:
+            self.root_text_written = True
+            if self.root.text:
+                self.out += self.escape(self.root.text)
+        child = next(self.root.iterchildren(), None)
+        while child is not None and child is not until:
+            next_child = child.getnext()
+            self.holder.append(child)
+            self.out += etree.tostring(child, encoding="UTF-8")
+            self.holder.remove(child)
+            child = next_child
+
+    def escape(self, text: str) -> bytes:
+        self.holder.text = text
+        escaped = etree.tostring(self.holder, encoding="UTF-8")[6:-7]
+        self.holder.text = None
+        return escaped
+
+    def result(self) -> ETRANResponse:
+        if self.fields.get("returnCode") != "0":
+            return ETRANResponse(True, self.fields.get("errorMessage"))
+        return ETRANResponse(False, self.out.decode())
+
+
+def parse_car_numbers(query: str) -> list[int]:
+    """Разбирает список номеров вагонов через запятую, возвращает их без повторов по возрастанию"""
     values = set()
 
     for value in map(str.strip, query.split(",")):
@@ -185,188 +352,264 @@ def request_SPV4650(query: str) -> str:
             raise ValueError(f"Некорректный номер вагона: {value}")
 
     if len(values):
-        return etran_template.format(
-            utils.xml_escape(request_template.format("".join(f"<vagon>{value}</vagon>" for value in values)))
-        )
+        return sorted(values)
     else:
         raise ValueError(f"Некорректный запрос: {query}")
 
 
-def request_SPV4712(query: str) -> str:
-    """Выполненные ремонты вагонов (SPV4712)"""
-    request_template = rf"""
-<GetInform>{"<UseGZIPBinary>1</UseGZIPBinary>" if config.ETRAN_GZIP else ""}
-<ns0:getReferenceSPV4712 xmlns:ns0="http://service.siw.pktbcki.rzd/">
-<ns0:ReferenceSPV4712Request>
-<idUser>0</idUser>
-<vagons>{{0}}</vagons>
-</ns0:ReferenceSPV4712Request>
-</ns0:getReferenceSPV4712>
-</GetInform>
+def split_wagon_response(text: str, wagon_sets: list[set[int]]) -> list[str]:
+    """Разделяет ответ на объединённый запрос по вагонам на ответы для исходных запросов
+
+    Дочерний элемент root относится к вагону, если среди его текстов есть номер этого вагона; служебные поля
+    (returnCode, errorMessage) есть в ответе на каждый запрос и попадают во все части. Часть собирается так,
+    будто из ответа удалены элементы чужих вагонов вместе с разделителями перед ними, и совпадает с текстом
+    ответа на отдельный запрос по её вагонам. Если какой-то элемент не относится ни к одному вагону, отнести
+    его к запросу нельзя, и возвращается None: исходные запросы нужно повторить по отдельности.
     """
-    values = set()
+    try:
+        root = etree.fromstring(text)
+    except etree.XMLSyntaxError:
+        # пустой ответ делить не на что
+        return [text] * len(wagon_sets)
+
+    all_wagons = set().union(*wagon_sets)
+    children = []
+    for child in root:
+        if child.tag in {"returnCode", "errorMessage"}:
+            children.append((child, None))
+            continue
+        numbers = {value.strip() for value in child.itertext()}
+        if not (child_wagons := {wagon for wagon in all_wagons if str(wagon) in numbers}):
+            return None
+        children.append((child, child_wagons))
+
+    parts = []
+    for wagons in wagon_sets:
+        part = etree.Element("root")
+        part.text = root.text
+        last, previous_tail = None, None
+        for child, child_wagons in children:
+            if child_wagons is None or child_wagons & wagons:
+                element = copy.deepcopy(child)
+                element.tail = None
+                # разделитель перед элементом в исходном ответе становится хвостом предыдущего взятого
+                if last is not None:
+                    last.tail = previous_tail
+                part.append(element)
+                last = element
+            previous_tail = child.tail
+        if last is not None:
+            last.tail = previous_tail
+        parts.append(etree.tostring(part, encoding="UTF-8").decode())
+    return parts
+
+
+def decode_wagon_response(response: bytes, wagon_sets: list[set[int]], stream: bool = False) -> ETRANResponse:
+    """Декодирует ответ на объединённый запрос по вагонам и делит его по исходным запросам
+
+    Если ответ не делится (см. split_wagon_response), parts остаётся None.
+    """
+    etran_response = decode_response_stream(response) if stream else decode_response(response)
+    if not etran_response.is_error:
+        etran_response.parts = split_wagon_response(etran_response.text, wagon_sets)
+    return etran_response
 
-    for value in map(str.strip, query.split(",")):
-        if not len(value):
-            pass
-        elif carnumber_pattern.fullmatch(value):
-            values.add(int(value))
-        else:
-            raise ValueError(f"Некорректный номер вагона: {value}")
 
-    if len(values):
-        return etran_template.format(
-            utils.xml_escape(request_template.format("".join(f"<vagon>{value}</vagon>" for value in values)))
-        )
-    else:
-        raise ValueError(f"Некорректный запрос: {query}")
+class RequestType:
+    """Тип запроса к ЭТРАН
 
+    template - внутренний XML запроса с полями {имя}, parse проверяет запрос из БД и возвращает значения полей
+    (фрагменты XML). Статические части конверта и шаблона экранируются и склеиваются один раз при создании,
+    так что построение запроса - это проверка, экранирование значений и одно соединение строк.
+    """
 
-def request_SPR2730(query: str) -> str:
-    """Сведения по узлам и деталям вагона (SPR2730)"""
-    request_template = rf"""
+    def __init__(self, description: str, template: str, parse):
+        self.description = description
+        self.parse = parse
+        envelope_prefix, envelope_suffix = etran_template.split("{0}")
+
+        # статические части вперемешку с полями: parts[0] field[0] parts[1] ... field[n-1] parts[n]
+        self.parts, self.fields = [], []
+        static = envelope_prefix
+        for text, field_name, _, _ in string.Formatter().parse(template):
+            static += utils.xml_escape(text)
+            if field_name is not None:
+                self.parts.append(static)
+                self.fields.append(field_name)
+                static = ""
+        self.parts.append(static + envelope_suffix)
+
+    def __call__(self, query: str) -> str:
+        values = self.parse(query)
+        body = [self.parts[0]]
+        for field_name, static in zip(self.fields, self.parts[1:]):
+            body.append(utils.xml_escape(values[field_name]))
+            body.append(static)
+        return "".join(body)
+
+
+def asoup_template(method: str, request: str, fields: str) -> str:
+    """Внутренний XML справочного запроса к АСОУП"""
+    return f"""
 <GetInform>{"<UseGZIPBinary>1</UseGZIPBinary>" if config.ETRAN_GZIP else ""}
-<ns0:getDataVagDetails xmlns:ns0="http://service.siw.pktbcki.rzd/">
-<ns0:ReferenceEDOK_SPR2730Request>
+<ns0:{method} xmlns:ns0="http://service.siw.pktbcki.rzd/">
+<ns0:{request}>
 <idUser>0</idUser>
-<vagons>{{0}}</vagons>
-</ns0:ReferenceEDOK_SPR2730Request>
-</ns0:getDataVagDetails>
+{fields}
+</ns0:{request}>
+</ns0:{method}>
 </GetInform>
     """
-    values = set()
-
-    for value in map(str.strip, query.split(",")):
-        if not len(value):
-            pass
-        elif carnumber_pattern.fullmatch(value):
-            values.add(int(value))
-        else:
-            raise ValueError(f"Некорректный номер вагона: {value}")
 
-    if len(values):
-        return etran_template.format(
-            utils.xml_escape(request_template.format("".join(f"<vagon>{value}</vagon>" for value in values)))
-        )
-    else:
-        raise ValueError(f"Некорректный запрос: {query}")
 
-
-def request_EGRPO(query: str) -> str:
-    """Справочник ЕГРПО"""
-    request_template = r"""
+def nsi_template(method: str, request: str, fields: str) -> str:
+    """Внутренний XML запроса к справочнику НСИ через АСОУП"""
+    return f"""
 <GetInformNSI>
-<ns0:getTN_EO_EGRPO_SKR xmlns:ns0="http://service.siw.pktbcki.rzd/">
-<ns0:TN_EO_EGRPO_SKRRequest>
-<okpoKod>{0}</okpoKod>
-</ns0:TN_EO_EGRPO_SKRRequest>
-</ns0:getTN_EO_EGRPO_SKR>
+<ns0:{method} xmlns:ns0="http://service.siw.pktbcki.rzd/">
+<ns0:{request}>
+{fields}
+</ns0:{request}>
+</ns0:{method}>
 </GetInformNSI>
     """
 
-    if okpo_pattern.fullmatch(query):
-        return etran_template.format(utils.xml_escape(request_template.format(query)))
+
+def parse_wagons(query: str) -> dict:
+    return {"vagons": "".join(f"<vagon>{value}</vagon>" for value in parse_car_numbers(query))}
+
+
+def parse_train_index(query: str) -> dict:
+    if m := train_index_pattern1.fullmatch(query):
+        train_index = f"{utils.get_code6(int(m.group(1)))}{m.group(2)}{utils.get_code6(int(m.group(3)))}"
+    elif train_index_pattern2.fullmatch(query):
+        train_index = query
     else:
-        raise ValueError(f"Некорректный код ОКПО: {query}")
+        raise ValueError(f"Некорректный формат индекса поезда: {query}")
+    return {"train_index": train_index}
 
 
-def request_Owner(query: str) -> str:
-    """Справочник предприятий собственников вагонов"""
-    request_template = r"""
-<GetInformNSI>
-<ns0:getAKPV_PREDSOB xmlns:ns0="http://service.siw.pktbcki.rzd/">
-<ns0:AKPV_PREDSOBRequest>
-{0}
-</ns0:AKPV_PREDSOBRequest>
-</ns0:getAKPV_PREDSOB>
-</GetInformNSI>
-    """
-    request = None
-
-    if digits_pattern.fullmatch(query):
-        request = f"<lC>{query}</lC>"
-    elif m := keyvalue_pattern.fullmatch(query):
-        key, value = m.group(1).lower(), m.group(2)
-        if digits_pattern.fullmatch(value):
-            if key == "id":
-                request = f"<lC>{value}</lC>"
-            elif key == "okpo":
-                request = f"<okpo>{value}</okpo>"
-
-    if request is None:
-        raise ValueError(f"Некорректный запрос: {query}")
+def parse_car_part(query: str) -> dict:
+    if m := carpart_pattern.fullmatch(query):
+        return dict(zip(("part_type", "part_number", "part_factory", "part_year"), m.group(1, 2, 3, 4)))
     else:
-        return etran_template.format(utils.xml_escape(request_template.format(request)))
+        raise ValueError(f"Некорректный формат номера детали: {query}")
 
 
-def request_CarNSI(query: str) -> str:
-    """НСИ вагона (АБД ПВ)"""
-    request_template = r"""
-<getCarNSI version="1.0">
-<car><carNumber value="{0}"/></car>
-</getCarNSI>
-    """
+def value_parser(field_name: str, pattern: re.Pattern, message: str):
+    """Запрос - одно значение, соответствующее pattern"""
 
-    if carnumber_pattern.fullmatch(query):
-        return etran_template.format(utils.xml_escape(request_template.format(query)))
-    else:
-        raise ValueError(f"Некорректный номер вагона: {query}")
+    def parse(query: str) -> dict:
+        if pattern.fullmatch(query):
+            return {field_name: query}
+        else:
+            raise ValueError(f"{message}: {query}")
 
+    return parse
 
-def request_OrgPassport(query: str) -> str:
-    """Паспорт организации (ПУЖТ)"""
-    request_template = r"""
-<getOrgPassport version="1.0">
-{0}
-</getOrgPassport>
-    """
-    request = None
-
-    if digits_pattern.fullmatch(query):
-        request = f'<orgID value="{query}"/>'
-    elif m := keyvalue_pattern.fullmatch(query):
-        key, value = m.group(1).lower(), m.group(2)
-        if digits_pattern.fullmatch(value):
-            if key == "id":
-                request = f'<orgID value="{value}"/>'
-            elif key == "inn":
-                request = f'<orgINN value="{value}"/>'
-            elif key == "okpo":
-                request = f'<orgOKPO value="{value}"/>'
-            elif key == "payercode":
-                request = f'<payerCode value="{value}"/>'
-
-    if request is None:
-        raise ValueError(f"Некорректный запрос: {query}")
-    else:
-        return etran_template.format(utils.xml_escape(request_template.format(request)))
 
+def keyvalue_parser(field_name: str, templates: dict):
+    """Запрос - число (значение ключа id) или ключ=число; templates - фрагменты XML для ключей"""
 
-def request_OrgPayers(query: str) -> str:
-    """Список кодов плательщика организации"""
-    request_template = r"""
-<getOrganizationPayers version="1.0">
-<OrgId value="{0}"/>
-</getOrganizationPayers>
-    """
+    def parse(query: str) -> dict:
+        fragment = None
+        if digits_pattern.fullmatch(query):
+            fragment = templates["id"].format(query)
+        elif m := keyvalue_pattern.fullmatch(query):
+            key, value = m.group(1).lower(), m.group(2)
+            if digits_pattern.fullmatch(value) and key in templates:
+                fragment = templates[key].format(value)
 
-    if digits_pattern.fullmatch(query):
-        return etran_template.format(utils.xml_escape(request_template.format(query)))
-    else:
-        raise ValueError(f"Некорректный формат запроса: {query}")
+        if fragment is None:
+            raise ValueError(f"Некорректный запрос: {query}")
+        return {field_name: fragment}
+
+    return parse
 
 
-# маппинг типов запросов в функции формирования их текста
+# маппинг типов запросов в их описания; описание вызывается с текстом запроса из БД и возвращает тело запроса
 request_map = {
-    1: request_SPP4700,
-    2: request_SPV4659,
-    3: request_SPV4716,
-    4: request_SPV4650,
-    5: request_SPV4712,
-    6: request_SPR2730,
-    50: request_EGRPO,
-    51: request_Owner,
-    100: request_CarNSI,
-    101: request_OrgPassport,
-    102: request_OrgPayers,
+    1: RequestType(
+        "Работа с поездом",
+        asoup_template("getReferenceSPP4700", "ReferenceSPP4700Request", "<indexPoezd>{train_index}</indexPoezd>"),
+        parse_train_index,
+    ),
+    2: RequestType(
+        "Техническое состояние вагонов",
+        asoup_template("getReferenceSPV4659", "ReferenceSPV4659Request", "<vagons>{vagons}</vagons>"),
+        parse_wagons,
+    ),
+    3: RequestType(
+        "Текущее состояние детали",
+        asoup_template(
+            "getReferenceSPV4716",
+            "ReferenceSPV4716Request",
+            "<tipDet>{part_type}</tipDet>\n<zavod>{part_factory}</zavod>\n"
+            "<nomDet>{part_number}</nomDet>\n<godPost>{part_year}</godPost>",
+        ),
+        parse_car_part,
+    ),
+    4: RequestType(
+        "Пробеги вагонов (SPV4650)",
+        asoup_template("getReferenceSPV4650", "ReferenceSPV4650Request", "<vagons>{vagons}</vagons>"),
+        parse_wagons,
+    ),
+    5: RequestType(
+        "Выполненные ремонты вагонов (SPV4712)",
+        asoup_template("getReferenceSPV4712", "ReferenceSPV4712Request", "<vagons>{vagons}</vagons>"),
+        parse_wagons,
+    ),
+    6: RequestType(
+        "Сведения по узлам и деталям вагона (SPR2730)",
+        asoup_template("getDataVagDetails", "ReferenceEDOK_SPR2730Request", "<vagons>{vagons}</vagons>"),
+        parse_wagons,
+    ),
+    50: RequestType(
+        "Справочник ЕГРПО",
+        nsi_template("getTN_EO_EGRPO_SKR", "TN_EO_EGRPO_SKRRequest", "<okpoKod>{okpo}</okpoKod>"),
+        value_parser("okpo", okpo_pattern, "Некорректный код ОКПО"),
+    ),
+    51: RequestType(
+        "Справочник предприятий собственников вагонов",
+        nsi_template("getAKPV_PREDSOB", "AKPV_PREDSOBRequest", "{request}"),
+        keyvalue_parser("request", {"id": "<lC>{}</lC>", "okpo": "<okpo>{}</okpo>"}),
+    ),
+    100: RequestType(
+        "НСИ вагона (АБД ПВ)",
+        """
+<getCarNSI version="1.0">
+<car><carNumber value="{car_number}"/></car>
+</getCarNSI>
+    """,
+        value_parser("car_number", carnumber_pattern, "Некорректный номер вагона"),
+    ),
+    101: RequestType(
+        "Паспорт организации (ПУЖТ)",
+        """
+<getOrgPassport version="1.0">
+{request}
+</getOrgPassport>
+    """,
+        keyvalue_parser(
+            "request",
+            {
+                "id": '<orgID value="{}"/>',
+                "inn": '<orgINN value="{}"/>',
+                "okpo": '<orgOKPO value="{}"/>',
+                "payercode": '<payerCode value="{}"/>',
+            },
+        ),
+    ),
+    102: RequestType(
+        "Список кодов плательщика организации",
+        """
+<getOrganizationPayers version="1.0">
+<OrgId value="{org_id}"/>
+</getOrganizationPayers>
+    """,
+        value_parser("org_id", digits_pattern, "Некорректный формат запроса"),
+    ),
 }
+
+# типы запросов по списку вагонов, которые можно объединять в один запрос
+wagon_request_types = {request_type for request_type, entry in request_map.items() if entry.parse is parse_wagons}
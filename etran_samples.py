@@ -0,0 +1,138 @@
+"""Синтетические ответы ЭТРАН для бенчмарков и отладки"""
+import base64
+import gzip
+from xml.sax.saxutils import escape
+
+# элементы ответов АСОУП по типам запросов: (ответ метода, справка, элемент строки справки)
+asoup_elements = {
+    1: ("getReferenceSPP4700Response", "referenceSPP4700", "vagon"),
+    2: ("getReferenceSPV4659Response", "referenceSPV4659", "vagon"),
+    3: ("getReferenceSPV4716Response", "referenceSPV4716", "detal"),
+    4: ("getReferenceSPV4650Response", "referenceSPV4650", "vagon"),
+    5: ("getReferenceSPV4712Response", "referenceSPV4712", "vagon"),
+    6: ("getDataVagDetailsResponse", "referenceEDOK_SPR2730_1", "detal"),
+    50: ("getTN_EO_EGRPO_SKRResponse", "TN_EO_EGRPO_SKR", "row"),
+    51: ("getAKPV_PREDSOBResponse", "AKPV_PREDSOB", "row"),
+}
+
+# справочники НСИ, отвечающие без обёртки АСОУП
+nsi_elements = {
+    100: "getCarNSIReply",
+    101: "getOrgPassportReply",
+    102: "getOrganizationPayersReply",
+}
+
+# справочники НСИ в обёртке АСОУП
+nsi_asoup_types = {50, 51}
+
+# элемент запроса (getReferenceSPV4659, getCarNSI, ...) -> тип запроса
+request_elements = {
+    **{method.removesuffix("Response"): request_type for request_type, (method, _, _) in asoup_elements.items()},
+    **{tag.removesuffix("Reply"): request_type for request_type, tag in nsi_elements.items()},
+}
+
+
+def sample_query(request_type: int, n: int) -> str:
+    """Корректный запрос типа request_type; разные n дают разные запросы"""
+    if request_type in {2, 4, 5, 6, 100}:
+        # номер вагона
+        return str(50000000 + n % 50000000)
+    elif request_type == 1:
+        # индекс поезда
+        return f"{n % 100000:05d}-{n % 1000:03d}-{n // 1000 % 100000:05d}"
+    elif request_type == 3:
+        # номер детали
+        return f"1-{n % 10**10}-{n % 10000}-2020"
+    else:
+        # ОКПО, код предприятия или организации
+        return str(n % (10**8 - 1) + 1)
+
+
+def item(tag: str, key, fields: int) -> str:
+    """Одна строка справки: номер объекта и fields полей с кириллицей и экранируемыми символами"""
+    values = "".join(f"<pole{i}>Значение {i} &amp; &lt;{key}&gt;</pole{i}>" for i in range(fields))
+    return f"<{tag}><nom>{key}</nom>{values}</{tag}>"
+
+
+def asoup_document(request_type: int, keys, fields: int = 10) -> bytes:
+    """Ответ АСОУП (Envelope/Body/...Response/return) на запрос по объектам keys"""
+    method, reference, row = asoup_elements[request_type]
+    if reference == "referenceEDOK_SPR2730_1":
+        # SPR2730 возвращает отдельную справку на каждый вагон прямо в return
+        payload = "\n".join(f"<{reference}>{item(row, key, fields)}</{reference}>" for key in keys)
+    else:
+        payload = f"<{reference}>\n" + "\n".join(item(row, key, fields) for key in keys) + f"\n</{reference}>"
+    return (
+        '<?xml version="1.0" encoding="windows-1251"?>'
+        '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+        f'<ns2:{method} xmlns:ns2="http://service.siw.pktbcki.rzd/"><return>'
+        f"{payload}<returnCode>0</returnCode>"
+        f"</return></ns2:{method}></S:Body></S:Envelope>"
+    ).encode()
+
+
+def inner_reply(request_type: int, keys, compressed: bool = True, fields: int = 10) -> str:
+    """Внутренний XML ответа, передаваемый в элементе Text"""
+    declaration = '<?xml version="1.0" encoding="windows-1251"?>'
+    if request_type in nsi_elements:
+        tag = nsi_elements[request_type]
+        return f'{declaration}<{tag} version="1.0">{"".join(item("row", key, fields) for key in keys)}</{tag}>'
+
+    return asoup_reply(request_type, asoup_document(request_type, keys, fields), compressed)
+
+
+def asoup_reply(request_type: int, document: bytes, compressed: bool = True) -> str:
+    """Внутренний XML ответа с документом АСОУП, сжатым (ASOUP64Reply) или экранированным (ASOUPReply)"""
+    declaration = '<?xml version="1.0" encoding="windows-1251"?>'
+    tag = "GetInformNSIReply" if request_type in nsi_asoup_types else "GetInformReply"
+    if compressed:
+        reply = base64.b64encode(gzip.compress(document)).decode()
+        return f"{declaration}<{tag}><ASOUP64Reply>{reply}</ASOUP64Reply></{tag}>"
+    else:
+        return f"{declaration}<{tag}><ASOUPReply>{escape(document.decode())}</ASOUPReply></{tag}>"
+
+
+def asoup_error_document(request_type: int, code: int, message: str) -> bytes:
+    """Ответ АСОУП с ненулевым кодом возврата"""
+    method = asoup_elements[request_type][0]
+    return (
+        '<?xml version="1.0" encoding="windows-1251"?>'
+        '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+        f'<ns2:{method} xmlns:ns2="http://service.siw.pktbcki.rzd/"><return>'
+        f"<returnCode>{code}</returnCode><errorMessage>{escape(message)}</errorMessage>"
+        f"</return></ns2:{method}></S:Body></S:Envelope>"
+    ).encode()
+
+
+def error_reply(code: int, message: str) -> str:
+    """Внутренний XML ответа с ошибкой"""
+    message = escape(message, {'"': "&quot;"})
+    return (
+        '<?xml version="1.0" encoding="windows-1251"?>'
+        f'<error><errorStatusCode value="{code}"/><errorMessage value="{message}"/></error>'
+    )
+
+
+def envelope(inner: str) -> bytes:
+    """Внешний SOAP-конверт ответа ЭТРАН"""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>'
+        f'<ns:GetBlockResponse xmlns:ns="SysEtranInt"><Text>{escape(inner)}</Text></ns:GetBlockResponse>'
+        "</soap:Body></soap:Envelope>"
+    ).encode()
+
+
+def make_response(request_type: int, keys, compressed: bool = True, fields: int = 10) -> bytes:
+    """Полный ответ ЭТРАН на запрос типа request_type по объектам keys"""
+    return envelope(inner_reply(request_type, keys, compressed, fields))
+
+
+def make_error_response(code: int, message: str) -> bytes:
+    """Полный ответ ЭТРАН с ошибкой"""
+    return envelope(error_reply(code, message))
+
+
+def make_asoup_error_response(request_type: int, code: int, message: str, compressed: bool = True) -> bytes:
+    """Полный ответ ЭТРАН с ошибкой АСОУП (ненулевой returnCode)"""
+    return envelope(asoup_reply(request_type, asoup_error_document(request_type, code, message), compressed))
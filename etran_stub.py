@@ -0,0 +1,181 @@
+"""Заглушка ЭТРАН для нагрузочных тестов
+
+Принимает те же SOAP-запросы, что формирует etran_requests, и отвечает синтетическими ответами etran_samples
+с заданным распределением задержки и долей ошибок отказа в обслуживании (400) и остановки ЭТРАН (504).
+Задержка: fixed:СЕКУНДЫ, uniform:ОТ:ДО, exp:СРЕДНЕЕ или lognormal:МЕДИАНА:SIGMA. С --login-concurrency
+запросы сверх заданного числа одновременных от одной учётной записи получают отказ в обслуживании, как в ЭТРАН.
+Пример: python etran_stub.py --port 8081 --latency lognormal:0.3:0.5 --dos-rate 0.05 --outage-rate 0.01
+"""
+import argparse
+import asyncio
+import collections
+import math
+import random
+
+from aiohttp import web
+from lxml import etree
+
+import etran_samples
+
+
+def parse_latency(spec: str):
+    """Возвращает функцию без аргументов, выдающую случайную задержку в секундах по описанию spec"""
+    kind, *args = spec.split(":")
+    args = [float(arg) for arg in args]
+    if kind == "fixed":
+        return lambda: args[0]
+    elif kind == "uniform":
+        return lambda: random.uniform(args[0], args[1])
+    elif kind == "exp":
+        return lambda: random.expovariate(1 / args[0]) if args[0] else 0.0
+    elif kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(args[0]), args[1])
+    else:
+        raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+def parse_request(body: bytes):
+    """Определяет по SOAP-запросу тип, объекты запроса, признак сжатия ответа и учётную запись"""
+    envelope = etree.fromstring(body)
+    login = envelope.findtext(".//Login")
+    text = envelope.find(".//Text").text
+    inner = etree.fromstring(text.strip().encode())
+
+    compressed = inner.find("UseGZIPBinary") is not None
+    if inner.tag in {"GetInform", "GetInformNSI"}:
+        inner = next(child for child in inner if child.tag != "UseGZIPBinary")
+    request_type = etran_samples.request_elements[etree.QName(inner).localname]
+
+    if not (keys := [vagon.text for vagon in inner.iter("vagon")]):
+        # первый непустой текст или атрибут value: индекс поезда, ОКПО, номер вагона НСИ и т.п.
+        keys = [
+            next(
+                value.strip()
+                for element in inner.iter()
+                if element.tag != "idUser"
+                for value in (element.text, element.get("value"))
+                if value is not None and value.strip()
+            )
+        ]
+    return request_type, keys, compressed, login
+
+
+class ETRANStub:
+    def __init__(
+        self,
+        latency: str = "fixed:0",
+        dos_rate: float = 0.0,
+        outage_rate: float = 0.0,
+        rows: int = 1,
+        fields: int = 10,
+        plain: bool = False,
+        http_gzip: bool = False,
+        login_concurrency: int = 0,
+        type_latency: dict = None,
+    ):
+        self.latency = parse_latency(latency)
+        # задержка отдельных типов запросов, например тяжёлых SPR2730
+        self.type_latency = {request_type: parse_latency(spec) for request_type, spec in (type_latency or {}).items()}
+        self.dos_rate = dos_rate
+        self.outage_rate = outage_rate
+        self.rows = rows
+        self.fields = fields
+        self.plain = plain
+        self.http_gzip = http_gzip
+        self.login_concurrency = login_concurrency
+        self.counters = collections.Counter()
+        # запросы в обработке по учётным записям
+        self.in_flight = collections.Counter()
+
+    async def handle(self, request):
+        if request.path == "/stats":
+            return web.json_response(self.counters)
+
+        body = await request.read()
+        try:
+            request_type, keys, compressed, login = parse_request(body)
+        except (etree.XMLSyntaxError, AttributeError, KeyError, StopIteration) as e:
+            await asyncio.sleep(self.latency())
+            self.counters["invalid"] += 1
+            response = etran_samples.make_error_response(400, f"Некорректный запрос: {repr(e)}")
+        else:
+            # ЭТРАН отказывает, если от учётной записи уже выполняется предельное число запросов
+            busy = self.login_concurrency and self.in_flight[login] >= self.login_concurrency
+            self.in_flight[login] += 1
+            try:
+                await asyncio.sleep(self.type_latency.get(request_type, self.latency)())
+            finally:
+                self.in_flight[login] -= 1
+            response = self.respond(request_type, keys, compressed, busy)
+
+        web_response = web.Response(body=response, content_type="text/xml", charset="utf-8")
+        if self.http_gzip:
+            web_response.enable_compression()
+        return web_response
+
+    def respond(self, request_type: int, keys: list[str], compressed: bool, busy: bool) -> bytes:
+        self.counters[f"type_{request_type}"] += 1
+        outcome = random.random()
+        if outcome < self.outage_rate:
+            self.counters["outage"] += 1
+            return etran_samples.make_error_response(504, "Сервис временно недоступен")
+        elif busy or outcome < self.outage_rate + self.dos_rate:
+            self.counters["dos"] += 1
+            return etran_samples.make_error_response(400, "Дождитесь окончания предыдущего запроса")
+        else:
+            self.counters["ok"] += 1
+            keys = [key for key in keys for _ in range(self.rows)]
+            return etran_samples.make_response(
+                request_type, keys, compressed=compressed and not self.plain, fields=self.fields
+            )
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=2**26)
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", default="lognormal:0.3:0.5", help="распределение задержки ответа")
+    parser.add_argument("--dos-rate", type=float, default=0.0, help="доля ответов 400 (отказ в обслуживании)")
+    parser.add_argument("--outage-rate", type=float, default=0.0, help="доля ответов 504 (остановка ЭТРАН)")
+    parser.add_argument("--rows", type=int, default=1, help="строк ответа на объект запроса")
+    parser.add_argument("--fields", type=int, default=10, help="полей в строке ответа")
+    parser.add_argument("--plain", action="store_true", help="ASOUPReply вместо ASOUP64Reply")
+    parser.add_argument("--http-gzip", action="store_true", help="сжимать HTTP-ответы")
+    parser.add_argument(
+        "--type-latency", nargs="*", default=[], metavar="TYPE=SPEC", help="распределение задержки отдельных типов"
+    )
+    parser.add_argument(
+        "--login-concurrency", type=int, default=0, help="одновременных запросов на учётную запись, 0 - без предела"
+    )
+
+
+def create_stub(args: argparse.Namespace) -> ETRANStub:
+    type_latency = {}
+    for item in args.type_latency:
+        request_type, _, spec = item.partition("=")
+        type_latency[int(request_type)] = spec
+    return ETRANStub(
+        args.latency,
+        args.dos_rate,
+        args.outage_rate,
+        args.rows,
+        args.fields,
+        args.plain,
+        args.http_gzip,
+        args.login_concurrency,
+        type_latency,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(create_stub(args).app(), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
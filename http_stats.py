@@ -0,0 +1,59 @@
+import collections
+import time
+
+import aiohttp
+
+
+class HTTPStats:
+    """Статистика пула HTTP-соединений с ЭТРАН по событиям трассировки aiohttp
+
+    Считает новые соединения (каждое - отдельное TCP- и TLS-рукопожатие), повторно использованные соединения,
+    ожидания свободного соединения в пуле и сжатые ответы; время запросов учитывается отдельно для запросов
+    по новым и по повторно использованным соединениям, чтобы было видно, сколько экономит пул.
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.durations = collections.Counter()
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self.on_request_start)
+        trace_config.on_connection_queued_start.append(self.on_connection_queued_start)
+        trace_config.on_connection_create_end.append(self.on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+        trace_config.on_dns_resolvehost_end.append(self.on_dns_resolvehost_end)
+        trace_config.on_request_end.append(self.on_request_end)
+        return trace_config
+
+    async def on_request_start(self, session, context, params):
+        context.start_time = time.monotonic()
+        context.connection = "reused"
+
+    async def on_connection_queued_start(self, session, context, params):
+        self.counters["queued"] += 1
+
+    async def on_connection_create_end(self, session, context, params):
+        self.counters["handshakes"] += 1
+        context.connection = "new"
+
+    async def on_connection_reuseconn(self, session, context, params):
+        self.counters["reused"] += 1
+
+    async def on_dns_resolvehost_end(self, session, context, params):
+        self.counters["dns_resolves"] += 1
+
+    async def on_request_end(self, session, context, params):
+        self.counters[f"{context.connection}_requests"] += 1
+        self.durations[context.connection] += time.monotonic() - context.start_time
+        if "Content-Encoding" in params.response.headers:
+            self.counters["compressed"] += 1
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            **{
+                f"{connection}_avg_ms": round(duration * 1000 / self.counters[f"{connection}_requests"], 1)
+                for connection, duration in self.durations.items()
+            },
+        }
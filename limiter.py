@@ -0,0 +1,99 @@
+import asyncio
+import collections
+import logging
+import time
+
+
+class AdaptiveLimiter:
+    """Адаптивный ограничитель числа параллельных запросов к ЭТРАН по схеме AIMD
+
+    Пока запросы проходят без ошибок и задержка не растёт, предел увеличивается примерно на единицу за каждый
+    "круг" запросов; при отказе в обслуживании, остановке ЭТРАН, таймауте или сетевой ошибке предел умножается
+    на backoff, но не чаще одного раза за время ответа, чтобы одна перегрузка не сбрасывала его многократно.
+    Рост задержки только приостанавливает увеличение предела: задержка сравнивается по каждому типу запроса
+    отдельно, короткое скользящее среднее - с длинным, поэтому разброс времени ответа и смесь быстрых и медленных
+    типов не принимаются за перегрузку. При min_limit == max_limit работает как обычный семафор.
+    """
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int, backoff: float, latency_tolerance: float):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        # по типам запросов: [короткое, длинное] скользящие средние задержки в секундах
+        self.latency = {}
+        # задержка для паузы между уменьшениями предела
+        self.latency_ewma = None
+        self.last_decrease = 0.0
+        self.counters = collections.Counter()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # передаём освободившееся место следующему
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                else:
+                    self.wake()
+                raise
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def on_success(self, latency: float, request_type: int = None):
+        """Учитывает успешный HTTP-запрос типа request_type длительностью latency секунд"""
+        self.counters["ok"] += 1
+        self.latency_ewma = latency if self.latency_ewma is None else 0.9 * self.latency_ewma + 0.1 * latency
+        if (averages := self.latency.get(request_type)) is None:
+            averages = self.latency[request_type] = [latency, latency]
+        else:
+            averages[0] = 0.9 * averages[0] + 0.1 * latency
+            averages[1] = 0.99 * averages[1] + 0.01 * latency
+
+        if averages[0] > averages[1] * self.latency_tolerance:
+            self.counters["latency_hold"] += 1
+        elif self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.wake()
+
+    def on_failure(self, kind: str):
+        """Учитывает неудачу: dos, outage, timeout, error"""
+        self.counters[kind] += 1
+        self.decrease(kind)
+
+    def decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency_ewma or 1.0):
+            return
+        self.last_decrease = now
+        limit = max(self.min_limit, self.limit * self.backoff)
+        if int(limit) != int(self.limit):
+            logging.warning(f"concurrency limit {int(self.limit)} -> {int(limit)} because of {reason}")
+        self.limit = limit
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": len(self.waiters),
+            "latency_ewma": self.latency_ewma,
+            "latency": {str(request_type): averages for request_type, averages in self.latency.items()},
+            **self.counters,
+        }
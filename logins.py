@@ -0,0 +1,113 @@
+import asyncio
+import collections
+import logging
+import time
+
+import etran_requests
+
+
+class Login:
+    """Учётная запись ЭТРАН и её текущая нагрузка"""
+
+    def __init__(self, login: str, password: str, concurrency: int):
+        self.login = login
+        self.concurrency = concurrency
+        # начало конверта с этими учётными данными вместо учётных данных по умолчанию
+        self.envelope_head = etran_requests.envelope_head(login, password)
+        self.in_flight = 0
+        self.dos_counter = 0
+        self.blocked_until = 0.0
+        self.last_used = 0.0
+        self.counters = collections.Counter()
+
+    def sign(self, request_body: str) -> str:
+        """Подставляет учётные данные в тело запроса, сформированное построителем"""
+        if self.envelope_head == etran_requests.default_envelope_head:
+            return request_body
+        return self.envelope_head + request_body[len(etran_requests.default_envelope_head) :]
+
+
+class LoginPool:
+    """Диспетчер учётных записей ЭТРАН
+
+    Отказ в обслуживании ("Дождитесь окончания предыдущего запроса") ЭТРАН выдаёт по учётной записи, поэтому
+    каждый запрос отправляется от имени наименее загруженной свободной записи, а пауза после отказа
+    (растущая с числом отказов подряд, как раньше у запроса) накладывается только на получившую его запись.
+    """
+
+    def __init__(self, credentials: list[dict], concurrency: int, sleep_on_dos: float, sleep_on_dos_max: float):
+        self.logins = {
+            credential["login"]: Login(
+                credential["login"], credential["password"], credential.get("concurrency", concurrency)
+            )
+            for credential in credentials
+        }
+        self.sleep_on_dos = sleep_on_dos
+        self.sleep_on_dos_max = sleep_on_dos_max
+        # событие срабатывает при освобождении записи и заменяется новым
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def acquire(self) -> Login:
+        """Дожидается свободной учётной записи и занимает её"""
+        while True:
+            now = time.monotonic()
+            available = [
+                login
+                for login in self.logins.values()
+                if login.in_flight < login.concurrency and login.blocked_until <= now
+            ]
+            if available:
+                login = min(available, key=lambda login: (login.in_flight, login.last_used))
+                login.in_flight += 1
+                login.last_used = now
+                return login
+
+            # ждём освобождения записи или конца ближайшей паузы
+            blocked = [login.blocked_until - now for login in self.logins.values() if login.blocked_until > now]
+            try:
+                await asyncio.wait_for(self.changed.wait(), min(blocked) if blocked else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def retry_delay(self) -> float:
+        """Через сколько секунд хотя бы одна учётная запись выйдет из паузы после отказа в обслуживании"""
+        now = time.monotonic()
+        return max(0.0, min(login.blocked_until for login in self.logins.values()) - now)
+
+    def release(self, login: Login):
+        login.in_flight -= 1
+        self.notify()
+
+    def on_success(self, login_name: str):
+        if (login := self.logins.get(login_name)) is not None:
+            login.counters["ok"] += 1
+            login.dos_counter = 0
+
+    def on_dos(self, login_name: str):
+        """Приостанавливает учётную запись, получившую отказ в обслуживании"""
+        if (login := self.logins.get(login_name)) is not None:
+            login.counters["dos"] += 1
+            if login.blocked_until > time.monotonic():
+                # отказ на запрос, отправленный одновременно с уже получившим отказ, паузу не удлиняет
+                return
+            login.dos_counter += 1
+            pause = min(login.dos_counter * self.sleep_on_dos, self.sleep_on_dos_max)
+            login.blocked_until = max(login.blocked_until, time.monotonic() + pause)
+            logging.warning(f"login {login_name} paused for {pause}s after {login.dos_counter} DoS errors in a row")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            login.login: {
+                "in_flight": login.in_flight,
+                "concurrency": login.concurrency,
+                "paused_for": round(max(0.0, login.blocked_until - now), 3),
+                "dos_counter": login.dos_counter,
+                **login.counters,
+            }
+            for login in self.logins.values()
+        }
@@ -1,23 +1,45 @@
 import asyncio
+import concurrent.futures
+import functools
 import logging
 import signal
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import aiohttp
-import aioodbc
-import pyodbc
 from aiohttp import web
 
 import config
 import etran_requests
 import utils
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from budget import ByteBudget
+from cache import ResponseCache
+from digests import UNCHANGED_MARKER, DigestIndex
+from http_stats import HTTPStats
+from limiter import AdaptiveLimiter
+from logins import LoginPool
+from metrics import CallbackGauge, ETRANMetrics
+from queue_store import (
+    FileQueueStore,
+    MemoryQueueStore,
+    ODBCQueueStore,
+    QueueStore,
+    SQLiteQueueStore,
+    memory_queue,
+)
+from scheduler import FairQueue
+from spool import Spool
+from tracing import Trace, TraceSink
 
 try:
     import systemd.daemon as systemd
 except ImportError:
     systemd = None
 
+# очередь из файла для хранилища "file"; создаёт batch.py перед запуском main
+file_queue = None
+
 
 @dataclass(order=True)
 class RequestPacket:
@@ -25,6 +47,17 @@ class RequestPacket:
     request_id: int
     body: str
     dos_counter: int
+    request_type: int = field(default=None, compare=False)
+    query: str = field(default=None, compare=False)
+    # запросы с тем же телом, ожидающие ответа на этот
+    followers: list[int] = field(default_factory=list, compare=False)
+    # исходные запросы, если это объединённый запрос по вагонам
+    parts: list["RequestPacket"] = field(default_factory=list, compare=False)
+    # учётная запись, от имени которой запрос отправлен последний раз
+    login: str = field(default=None, compare=False)
+    # время поступления, от него считаются старение и срок ожидания в FairQueue, в том числе после повторов
+    created: float = field(default_factory=time.monotonic, compare=False)
+    trace: Trace = field(default_factory=Trace, compare=False)
 
 
 @dataclass()
@@ -33,45 +66,49 @@ class ResponsePacket:
     is_error: bool
     body: bytes
     request_packet: RequestPacket
+    # неудачные попытки декодирования, см. DECODE_ATTEMPTS
+    decode_attempts: int = 0
 
 
-async def producer_db(db_cursor, queue_in, queue_out):
-    """Наполняет очередь обработки queue_in запросами из БД"""
+@dataclass()
+class ResultPacket:
+    request_id: int
+    is_error: bool
+    text: str  # None - результат вытеснен из памяти и хранится только в spool
+    request_type: int = None
+    # длина текста, учтённая в byte_budget
+    size: int = 0
+    # трасса запроса; у результатов из кэша и присоединившихся запросов её нет
+    trace: Trace = None
+    # тело запроса для сравнения ответа с прежним в digest_index; хэш ответа и номер запроса с таким же ответом
+    request_body: str = None
+    digest: bytes = None
+    same_as: int = None
+
+
+async def producer_db(store, queue_in, queue_out, queue_db, queue_batch, in_flight):
+    """Наполняет очередь обработки queue_in запросами из БД, объединяя одинаковые запросы через in_flight"""
     task_name = "producer"
 
     while True:
         try:
             # Запрашиваем ровно недостающее до полной очереди количество записей. Это нужно на случай, если неожиданно
             # придут высокоприоритетные запросы, чтобы они быстро, как только освободятся воркеры, попали в очередь.
-            if (batch_size := config.QUEUE_MAXSIZE - queue_in.qsize()) > 0:
-                await db_cursor.execute("EXEC etran.GetRequestQueue @MaxCount=?", batch_size)
-                rows = await db_cursor.fetchall()
+            if (batch_size := config.QUEUE_MAXSIZE - queue_in.qsize() - queue_batch.qsize() - len(retry_queue)) > 0:
+                rows = await store.get_requests(batch_size)
                 for row in rows:
-                    request_id, request_type, request_priority, request_body = row.ID, row.TypeID, row.Priority, None
-                    logging.info(f"{task_name} id={request_id} type={request_type} priority={request_priority}")
-
-                    # формируем тело запроса в соответствии с его типом
-                    try:
-                        if request_type in etran_requests.request_map:
-                            request_body = etran_requests.request_map[request_type](row.Query)
-                        else:
-                            raise ValueError(f"Неизвестный тип запроса: {request_type}")
-                    except ValueError as e:
-                        # чтобы не получать некорректный запрос бесконечно, сразу помещаем ошибку в очередь ответов
-                        logging.warning(f"{task_name} id={request_id} {repr(e)}")
-                        await queue_out.put(
-                            ResponsePacket(
-                                request_id,
-                                is_error=True,
-                                body=repr(e).encode(),
-                                request_packet=None,
-                            )
-                        )
-
-                    # отправляем в очередь обработки запросов
-                    if request_body is not None:
-                        request_packet = RequestPacket(request_priority, request_id, request_body, dos_counter=0)
-                        await queue_in.put(request_packet)
+                    await intake_request(
+                        queue_in,
+                        queue_out,
+                        queue_db,
+                        queue_batch,
+                        in_flight,
+                        row.ID,
+                        row.TypeID,
+                        row.Priority,
+                        row.Query,
+                        task_name,
+                    )
 
             # цикл работы producer'а закончился; засыпаем, чтобы не тиранить БД
             sleep_for = config.DB_QUERYING_INTERVAL if len(rows) else config.DB_POLLING_INTERVAL
@@ -81,140 +118,702 @@ async def producer_db(db_cursor, queue_in, queue_out):
         except Exception as e:
             logging.error(f"{task_name} {repr(e)}")
 
-            if isinstance(e, pyodbc.Error):
-                raise_on_pyodbc_disconnect(e)
+            if isinstance(e, store.Error):
+                raise_on_disconnect(store, e)
+
+
+async def intake_request(
+    queue_in,
+    queue_out,
+    queue_db,
+    queue_batch,
+    in_flight,
+    request_id: int,
+    request_type: int,
+    request_priority: int,
+    query: str,
+    task_name: str,
+    batch: bool = True,
+) -> str:
+    """Формирует тело запроса и направляет его в кэш, к такому же запросу в работе, в batcher или в queue_in"""
+    logging.info(f"{task_name} id={request_id} type={request_type} priority={request_priority}")
+
+    # результат уже получен от ЭТРАН и ждёт записи в spool, повторно не запрашиваем
+    if spool is not None and request_id in spool:
+        logging.info(f"{task_name} id={request_id} found in spool")
+        await queue_db.put(ResultPacket(request_id, None, None, request_type))
+        return "spooled"
+
+    # формируем тело запроса в соответствии с его типом
+    try:
+        if request_type in etran_requests.request_map:
+            request_body = etran_requests.request_map[request_type](query)
+        else:
+            raise ValueError(f"Неизвестный тип запроса: {request_type}")
+    except ValueError as e:
+        # чтобы не получать некорректный запрос бесконечно, сразу помещаем ошибку в очередь ответов
+        logging.warning(f"{task_name} id={request_id} {repr(e)}")
+        body = repr(e).encode()
+        byte_budget.add("out", len(body))
+        await queue_out.put(ResponsePacket(request_id, is_error=True, body=body, request_packet=None))
+        return "invalid"
+
+    if (cached_text := await response_cache.get(request_type, request_body)) is not None:
+        logging.info(f"{task_name} id={request_id} cache hit")
+        await put_to_db(
+            queue_db, [ResultPacket(request_id, False, cached_text, request_type, request_body=request_body)]
+        )
+        return "cached"
+
+    if leader := in_flight.get(request_body):
+        # запрос может прийти дважды: из БД и через /enqueue
+        if request_id == leader.request_id or request_id in leader.followers:
+            logging.info(f"{task_name} id={request_id} is already in progress")
+            return "duplicate"
+        # такой же запрос уже в работе, ждём его ответа вместо отдельного обращения в ЭТРАН
+        logging.info(f"{task_name} id={request_id} coalesced with id={leader.request_id}")
+        leader.followers.append(request_id)
+        return "coalesced"
+
+    # отправляем в очередь обработки запросов
+    request_packet = RequestPacket(
+        request_priority,
+        request_id,
+        request_body,
+        dos_counter=0,
+        request_type=request_type,
+        query=query,
+    )
+    in_flight[request_body] = request_packet
+    # запросы по вагонам batcher объединяет в многовагонные
+    if batch and config.WAGON_BATCH_SIZE > 1 and request_type in etran_requests.wagon_request_types:
+        request_packet.trace.mark("batch")
+        await queue_batch.put(request_packet)
+    else:
+        await queue_in.put(request_packet)
+    return "queued"
 
 
-async def worker(queue_in, queue_out):
-    """Разбирает очередь запросов queue_in, отправляет их в ЭТРАН, помещает ответы в queue_out"""
-    global etran_is_down
+async def batcher(queue_batch, queue_in):
+    """Объединяет запросы по вагонам одного типа из queue_batch в многовагонные и помещает их в queue_in"""
+    task_name = "batcher"
+
+    while True:
+        batch = await utils.get_batch(queue_batch, config.QUEUE_MAXSIZE, config.WAGON_BATCH_WAIT)
+
+        groups = {}
+        for request_packet in batch:
+            groups.setdefault(request_packet.request_type, []).append(request_packet)
+
+        for request_type, request_packets in groups.items():
+            group, group_wagons = [], set()
+            for request_packet in request_packets:
+                wagons = set(etran_requests.parse_car_numbers(request_packet.query))
+                if group and len(group_wagons | wagons) > config.WAGON_BATCH_SIZE:
+                    await queue_in.put(merge_request_packets(group, task_name))
+                    group, group_wagons = [], set()
+                group.append(request_packet)
+                group_wagons |= wagons
+            await queue_in.put(merge_request_packets(group, task_name))
+
+        for _ in batch:
+            queue_batch.task_done()
+
+
+def merge_request_packets(request_packets: list[RequestPacket], task_name: str) -> RequestPacket:
+    """Собирает из запросов по вагонам одного типа один запрос"""
+    if len(request_packets) == 1:
+        return request_packets[0]
+
+    first = request_packets[0]
+    query = ",".join(request_packet.query for request_packet in request_packets)
+    logging.info(
+        f"{task_name} id={first.request_id} type={first.request_type} merged "
+        f"ids={[request_packet.request_id for request_packet in request_packets]}"
+    )
+    return RequestPacket(
+        min(request_packet.priority for request_packet in request_packets),
+        first.request_id,
+        etran_requests.request_map[first.request_type](query),
+        dos_counter=0,
+        request_type=first.request_type,
+        query=query,
+        parts=request_packets,
+        created=min(request_packet.created for request_packet in request_packets),
+        trace=Trace("merged"),
+    )
+
+
+async def worker(session, queue_in, queue_out):
+    """Разбирает очередь запросов queue_in, отправляет их в ЭТРАН через общую session, помещает ответы в queue_out"""
     task_name = asyncio.current_task().get_name()
 
-    async with aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(ttl_dns_cache=300),
-        timeout=aiohttp.ClientTimeout(total=config.REQUEST_TIMEOUT),
-        raise_for_status=True,
-    ) as session:
-        while True:
-            request_packet = await queue_in.get()
-            request_id = request_packet.request_id
-
-            if (
-                sleep_for := config.SLEEP_ON_DOS_MAX
-                # делаем длинную паузу в случае остановки ЭТРАН
-                if etran_is_down
-                # делаем инкрементальную паузу, если запрос повторно оказался в очереди при ошибке отказа в обслуживании
-                else min(
-                    request_packet.dos_counter * config.SLEEP_ON_DOS,
-                    config.SLEEP_ON_DOS_MAX,
+    # при остановке воркер доводит до конца отправленный запрос и завершается
+    while not stopping.is_set():
+        # пока ответы и результаты занимают больше BYTE_BUDGET байт, новые запросы не берутся
+        await byte_budget.wait()
+        # воркеров CONCURRENCY_MAX, одновременно работают столько, сколько разрешает ограничитель
+        await concurrency_limiter.acquire()
+        # при остановке ЭТРАН ждём, пока пробный запрос не покажет, что он снова работает
+        probe = await circuit_breaker.acquire()
+        request_packet = await queue_in.get()
+        # учётную запись берём только для готового к отправке запроса: ожидающий работы воркер не должен держать
+        # запись, иначе после отказа в обслуживании он отправил бы через неё повтор, не дожидаясь конца паузы
+        login = await login_pool.acquire()
+        request_id = request_packet.request_id
+        request_packet.login = login.login
+        sending.add(asyncio.current_task())
+        metrics.in_flight.inc()
+        metrics.queue_wait.observe(time.monotonic() - request_packet.created, request_packet.request_type)
+        request_packet.trace.mark("etran")
+
+        try:
+            start_time = time.monotonic()
+            async with session.post(
+                config.ETRAN_URL,
+                data=login.sign(request_packet.body),
+                headers=config.ETRAN_HEADERS,
+            ) as response:
+                response_body = await response.read()
+                duration = time.monotonic() - start_time
+                concurrency_limiter.on_success(duration, request_packet.request_type)
+                metrics.etran_latency.observe(duration, request_packet.request_type)
+                metrics.bytes_received.inc(request_packet.request_type, amount=len(response_body))
+
+                # with open("dump.xml", "wb") as f:
+                #     f.write(response_body)
+
+                # отправляем в очередь обработки ответов # TODO: пустое тело ответа?
+                logging.info(
+                    "%s id=%d status=%s len=%d duration=%.0fms queue_in=%d queue_out=%d",
+                    task_name,
+                    request_id,
+                    response.status,
+                    len(response_body),
+                    duration * 1000,
+                    queue_in.qsize(),
+                    queue_out.qsize(),
                 )
-            ):
-                logging.warning(
-                    f"{task_name} id={request_id} going to sleep for {sleep_for}s "
-                    f"because of {'an outage' if etran_is_down else 'DoS'}"
+                response_packet = ResponsePacket(request_id, False, response_body, request_packet)
+                request_packet.trace.mark("queue_out")
+                byte_budget.add("out", len(response_body))
+                await queue_out.put(response_packet)
+                # исход пробного запроса определит consumer по ответу
+                probe = None
+
+        except aiohttp.ClientError as e:
+            # в случае сетевой ошибки возвращаем запрос в очередь с паузой
+            logging.warning(
+                f"{task_name} id={request_id} retrying in {config.SLEEP_ON_DISCONNECT}s because of {repr(e)}"
+            )
+            concurrency_limiter.on_failure("error")
+            circuit_breaker.on_failure("error")
+            metrics.outcomes.inc(request_packet.request_type, "network")
+            request_packet.trace.retry("network")
+            retry_queue.put(request_packet, config.SLEEP_ON_DISCONNECT)
+
+        except asyncio.TimeoutError:
+            logging.warning(f"{task_name} id={request_id} timed out")
+            concurrency_limiter.on_failure("timeout")
+            circuit_breaker.on_failure("timeout")
+            metrics.outcomes.inc(request_packet.request_type, "timeout")
+            request_packet.trace.retry("timeout")
+            retry_queue.put(request_packet, 0)
+
+        except Exception as e:
+            # этот код не должен выполняться, оставлен для отладки
+            logging.error(f"{task_name} {repr(e)}")
+            request_packet.trace.retry("error")
+            retry_queue.put(request_packet, 0)
+
+        finally:
+            # пробный запрос без ответа иначе навсегда оставил бы автомат защиты полуоткрытым
+            circuit_breaker.release(probe)
+
+        # задачу нужно завершить при любом, даже неудачном исходе, иначе join() повиснет
+        metrics.in_flight.dec()
+        sending.discard(asyncio.current_task())
+        queue_in.task_done(request_packet)
+        login_pool.release(login)
+        concurrency_limiter.release()
+
+
+async def consumer_db(queue_out, queue_db, in_flight):
+    """Разбирает очередь ответов queue_out, декодирует их в своём пуле декодирования, помещает результаты в queue_db"""
+    task_name = "consumer"
+    # декодирования в работе: задача -> (исходный пакет, пул, в котором оно идёт)
+    decoding = {}
+    getter = None
+    decode_executor = create_decode_executor()
+
+    try:
+        while True:
+            # держим в работе несколько декодирований сразу, чтобы загрузить все ядра пула
+            if getter is None and len(decoding) < config.DECODE_WORKERS * 2:
+                getter = asyncio.create_task(queue_out.get())
+
+            done, _ = await asyncio.wait({*decoding, getter} - {None}, return_when=asyncio.FIRST_COMPLETED)
+
+            if getter in done:
+                response_packet = getter.result()
+                getter = None
+                if response_packet.request_packet is not None:
+                    response_packet.request_packet.trace.mark("decode")
+                decoding[asyncio.create_task(decode_response(response_packet, decode_executor))] = (
+                    response_packet,
+                    decode_executor,
                 )
-                await asyncio.sleep(sleep_for)
-
-            try:
-                start_time = time.monotonic()
-                async with session.post(
-                    config.ETRAN_URL,
-                    data=request_packet.body,
-                    headers=config.ETRAN_HEADERS,
-                ) as response:
-                    response_body = await response.read()
-
-                    # with open("dump.xml", "wb") as f:
-                    #     f.write(response_body)
-
-                    # отправляем в очередь обработки ответов # TODO: пустое тело ответа?
-                    logging.info(
-                        "%s id=%d status=%s len=%d duration=%.0fms queue_in=%d queue_out=%d",
-                        task_name,
-                        request_id,
-                        response.status,
-                        len(response_body),
-                        (time.monotonic() - start_time) * 1000,
-                        queue_in.qsize(),
-                        queue_out.qsize(),
+
+            # передаём ответы на запись в порядке завершения декодирования
+            for task in done & decoding.keys():
+                response_packet, task_executor = decoding.pop(task)
+                try:
+                    return_to_queue, request_id, response_is_error, response_text, outcome = decode_response_packet(
+                        response_packet, task.result()
                     )
-                    response_packet = ResponsePacket(request_id, False, response_body, request_packet)
-                    await queue_out.put(response_packet)
-
-            except aiohttp.ClientError as e:
-                # в случае сетевой ошибки возвращаем запрос в очередь и делаем паузу
-                logging.warning(
-                    f"{task_name} id={request_id} going to sleep for "
-                    f"{config.SLEEP_ON_DISCONNECT}s because of {repr(e)}"
-                )
-                await queue_in.put(request_packet)
-                await asyncio.sleep(config.SLEEP_ON_DISCONNECT)
 
-            except asyncio.TimeoutError:
-                logging.warning(f"{task_name} id={request_id} timed out")
-                await queue_in.put(request_packet)
+                    etran_response, request_packet = task.result(), response_packet.request_packet
+
+                    if return_to_queue:
+                        # после отказа в обслуживании паузу выдерживает получившая его учётная запись: запрос уйдёт
+                        # через другую, если она не на паузе, а иначе ждёт конца ближайшей паузы; при остановке
+                        # ЭТРАН запрос возвращается сразу, отправку придерживает circuit_breaker
+                        logging.warning(
+                            f"{task_name} id={request_id} returning to the queue because of {response_text}"
+                        )
+                        request_packet.trace.retry(outcome)
+                        retry_queue.put(request_packet, login_pool.retry_delay() if outcome == "dos" else 0)
+                    elif request_packet is not None and request_packet.parts and (
+                        response_is_error or etran_response.parts is None
+                    ):
+                        # ошибка может быть вызвана одним из вагонов, а ответ без ошибки может не разделиться
+                        # по вагонам, поэтому повторяем исходные запросы по отдельности
+                        logging.warning(
+                            f"{task_name} id={request_id} splitting merged request because of "
+                            f"{response_text if response_is_error else 'unsplittable response'}"
+                        )
+                        request_packet.trace.retry("split")
+                        for part in request_packet.parts:
+                            part.trace.absorb(request_packet.trace)
+                            # не через ограниченную queue_in: единственный consumer не должен ждать в ней места,
+                            # пока воркеры ждут, что он освободит байты ответов или решит исход пробного запроса
+                            retry_queue.put(part, 0)
+                    elif request_packet is not None and request_packet.parts:
+                        for part, part_text in zip(request_packet.parts, etran_response.parts):
+                            logging.info(
+                                f"{task_name} id={part.request_id} merged into id={request_id} len={len(part_text)}"
+                            )
+                            part.trace.absorb(request_packet.trace)
+                            await put_results(queue_db, in_flight, part.request_id, part, False, part_text)
+                    else:
+                        logging.info(
+                            f"{task_name} id={request_id} is_error={response_is_error} len={len(response_text)}"
+                            f"{f' error: {response_text}' if response_is_error else ''}"
+                        )
+                        await put_results(
+                            queue_db, in_flight, request_id, request_packet, response_is_error, response_text
+                        )
+                    byte_budget.release("out", len(response_packet.body))
+
+                except Exception as e:
+                    logging.error(f"{task_name} id={response_packet.request_id} {repr(e)}")
+                    if isinstance(e, concurrent.futures.BrokenExecutor) and task_executor is decode_executor:
+                        # процесс пула погиб (например, от нехватки памяти на огромном ответе), пул больше
+                        # не работает; остальные декодирования в нём завершатся той же ошибкой
+                        logging.error(f"{task_name} decode executor is broken, recreating it")
+                        decode_executor.shutdown(wait=False)
+                        decode_executor = create_decode_executor()
+                    response_packet.decode_attempts += 1
+                    if response_packet.decode_attempts < config.DECODE_ATTEMPTS:
+                        await queue_out.put(response_packet)
+                    else:
+                        await give_up_decoding(queue_db, in_flight, response_packet, e)
+
+                finally:
+                    # задачу нужно завершить при любом, даже неудачном исходе, иначе join() повиснет
+                    queue_out.task_done()
+
+    finally:
+        # при остановке корутины возвращаем в очередь всё, что не успели декодировать
+        if getter is not None:
+            if getter.done() and not getter.cancelled():
+                decoding[getter] = (getter.result(), None)
+            else:
+                getter.cancel()
+        for task, (response_packet, _) in decoding.items():
+            task.cancel()
+            queue_out.put_nowait(response_packet)
+            queue_out.task_done()
+        decode_executor.shutdown()
+
+
+async def give_up_decoding(queue_db, in_flight, response_packet: ResponsePacket, exc: Exception):
+    """Записывает ошибкой ответ, который не удалось декодировать DECODE_ATTEMPTS раз подряд"""
+    logging.error(f"consumer id={response_packet.request_id} not decoded in {response_packet.decode_attempts} attempts")
+    byte_budget.release("out", len(response_packet.body))
+    request_packet = response_packet.request_packet
+    if request_packet is not None and request_packet.parts:
+        # в объединённом ответе виноват может быть один вагон, исходные запросы повторяются по отдельности
+        request_packet.trace.retry("split")
+        for part in request_packet.parts:
+            part.trace.absorb(request_packet.trace)
+            retry_queue.put(part, 0)
+    else:
+        text = f"<root>{repr(exc)}</root>"
+        await put_results(queue_db, in_flight, response_packet.request_id, request_packet, True, text)
+
+
+async def put_results(queue_db, in_flight, request_id, request_packet, is_error, text):
+    """Помещает результат в очередь записи для запроса и всех присоединившихся к нему одинаковых запросов"""
+    if request_packet is None:
+        await put_to_db(queue_db, [ResultPacket(request_id, is_error, text)])
+        return
+
+    in_flight.pop(request_packet.body, None)
+    if not is_error:
+        await response_cache.put(request_packet.request_type, request_packet.body, text)
+
+    request_packet.trace.mark("queue_db")
+    request_type = request_packet.request_type
+    await put_to_db(
+        queue_db,
+        [
+            ResultPacket(
+                request_id, is_error, text, request_type, trace=request_packet.trace, request_body=request_packet.body
+            ),
+            *(
+                ResultPacket(follower, is_error, text, request_type, request_body=request_packet.body)
+                for follower in request_packet.followers
+            ),
+        ],
+    )
+
 
-            except Exception as e:
-                # этот код не должен выполняться, оставлен для отладки
-                logging.error(f"{task_name} {repr(e)}")
-                await queue_in.put(request_packet)
+async def put_to_db(queue_db, result_packets: list[ResultPacket]):
+    """Помещает результаты в очередь записи, предварительно сохранив их в spool, и учитывает их в byte_budget"""
+    if spool is not None:
+        await spool.add(
+            [
+                (result_packet.request_id, result_packet.is_error, result_packet.text, result_packet.request_type)
+                for result_packet in result_packets
+            ]
+        )
+    for result_packet in result_packets:
+        # БД недоступна или не успевает: в памяти остаётся только номер, текст writer прочитает из spool
+        if spool is not None and queue_db.qsize() >= config.SPOOL_MEMORY_LIMIT:
+            result_packet = ResultPacket(
+                result_packet.request_id,
+                None,
+                None,
+                result_packet.request_type,
+                trace=result_packet.trace,
+                request_body=result_packet.request_body,
+            )
+        elif result_packet.text is not None:
+            result_packet.size = len(result_packet.text)
+            byte_budget.add("db", result_packet.size)
+        await queue_db.put(result_packet)
+
+
+async def lease_keeper(store):
+    """Продлевает аренду взятых экземпляром запросов и возвращает в очередь запросы упавших экземпляров"""
+    task_name = "lease_keeper"
 
-            # задачу нужно завершить при любом, даже неудачном исходе, иначе join() повиснет
-            queue_in.task_done()
+    while True:
+        # продлеваем трижды за срок аренды, чтобы одна неудачная попытка не привела к потере запросов
+        await asyncio.sleep(config.LEASE_TIME / 3)
+        renewed = await store.renew_leases()
+        if reclaimed := await store.reclaim_expired():
+            logging.warning(f"{task_name} reclaimed {reclaimed} expired requests")
+            db_polling_sleep.cancel_all()
+        logging.info(f"{task_name} renewed {renewed} leases")
 
 
-async def consumer_db(db_cursor, queue_in, queue_out):
-    """Разбирает очередь ответов queue_out, записывает результаты в БД"""
-    task_name = "consumer"
+async def writer_db(store, queue_db):
+    """Разбирает очередь результатов queue_db пачками, записывает их в БД"""
+    task_name = asyncio.current_task().get_name()
 
     while True:
+        batch = await utils.get_batch(queue_db, config.DB_BATCH_SIZE, config.DB_BATCH_TIMEOUT)
+        for result_packet in batch:
+            if result_packet.trace is not None:
+                result_packet.trace.mark("db_write")
         try:
-            response_packet = await queue_out.get()
-            return_to_queue, request_id, response_is_error, response_text = decode_response_packet(response_packet)
-
-            if return_to_queue:
-                logging.warning(f"{task_name} id={request_id} returning to the queue because of {response_text}")
-                await queue_in.put(response_packet.request_packet)
-            else:
-                logging.info(
-                    f"{task_name} id={request_id} is_error={response_is_error} len={len(response_text)}"
-                    f"{f' error: {response_text}' if response_is_error else ''}"
-                )
-                await db_cursor.execute(
-                    "EXEC etran.SetRequestResponse @RequestID=?, @IsError=?, @Response=?",
-                    request_id,
-                    response_is_error,
-                    response_text,
-                )
+            results = await load_spilled(batch) if spool is not None else batch
+            if digest_index is not None:
+                # ответ, совпадающий с последним записанным на такой же запрос, записывается маркером
+                await digest_index.check(results)
+            # writer'ов несколько, каждый со своим соединением; у запроса ровно один окончательный результат,
+            # поэтому пачки на разных соединениях никогда не пишут одну и ту же запись
+            failed = await write_results(store, results, task_name) if results else []
+            for result_packet in failed:
+                # неудачные записи пробуем записать ещё раз, остальные записи пачки от них не страдают
+                await queue_db.put(result_packet)
+            # незаписанные результаты остаются в памяти
+            byte_budget.release("db", sum(result.size for result in batch) - sum(result.size for result in failed))
+            failed_ids = {result_packet.request_id for result_packet in failed}
+            written = [result for result in results if result.request_id not in failed_ids]
+            if spool is not None:
+                await spool.remove([result.request_id for result in written])
+            if digest_index is not None:
+                await digest_index.update(written)
+            for result_packet in written:
+                if result_packet.trace is not None:
+                    trace_sink.finish(result_packet.request_id, result_packet.request_type, result_packet.trace)
+
+        except BaseException:
+            # соединение прервалось или корутину остановили, пачка целиком возвращается в очередь
+            for result_packet in batch:
+                queue_db.put_nowait(result_packet)
+            raise
 
-        except Exception as e:
-            logging.error(f"{task_name} {repr(e)}")
-            await queue_out.put(response_packet)
+        finally:
+            # задачу нужно завершить при любом, даже неудачном исходе, иначе join() повиснет
+            for _ in batch:
+                queue_db.task_done()
+
+
+async def load_spilled(batch: list[ResultPacket]) -> list[ResultPacket]:
+    """Дополняет вытесненные из памяти результаты текстами из spool"""
+    spilled = await spool.load([result_packet.request_id for result_packet in batch if result_packet.text is None])
+    results = []
+    for result_packet in batch:
+        if result_packet.text is None:
+            if result_packet.request_id not in spilled:
+                # уже записан другим writer'ом
+                continue
+            result_packet.is_error, result_packet.text = spilled[result_packet.request_id]
+        results.append(result_packet)
+    return results
+
+
+async def write_results(store: QueueStore, batch: list[ResultPacket], task_name: str) -> list[ResultPacket]:
+    """Записывает пачку результатов в БД одним вызовом, при ошибке - построчно; возвращает незаписанные"""
+    rows = [
+        (
+            result_packet.request_id,
+            result_packet.is_error,
+            result_packet.text
+            if result_packet.same_as is None
+            else UNCHANGED_MARKER.format(request_id=result_packet.same_as),
+        )
+        for result_packet in batch
+    ]
+    start_time = time.monotonic()
+    try:
+        await store.set_responses(rows)
+        logging.info(f"{task_name} wrote {len(rows)} results")
+        duration = (time.monotonic() - start_time) / len(rows)
+        for result_packet in batch:
+            metrics.db_write_time.observe(duration, result_packet.request_type)
+        return []
+
+    except store.Error as e:
+        raise_on_disconnect(store, e)
+        logging.warning(f"{task_name} batch of {len(rows)} failed, writing row by row because of {repr(e)}")
+
+    failed = []
+    for result_packet, row in zip(batch, rows):
+        try:
+            start_time = time.monotonic()
+            await store.set_response(*row)
+            metrics.db_write_time.observe(time.monotonic() - start_time, result_packet.request_type)
+        except store.Error as e:
+            raise_on_disconnect(store, e)
+            logging.error(f"{task_name} id={result_packet.request_id} {repr(e)}")
+            failed.append(result_packet)
+    return failed
+
+
+async def decode_response(response_packet: ResponsePacket, decode_executor):
+    """Декодирует ответ ЭТРАН в пуле decode_executor, не блокируя цикл событий"""
+    if response_packet.is_error:
+        # ошибка напрямую из producer'а, декодировать нечего
+        return None
+
+    loop = asyncio.get_running_loop()
+    start_time = time.monotonic()
+    if parts := response_packet.request_packet.parts:
+        # ответ на объединённый запрос сразу делится по исходным запросам, тоже в пуле
+        wagon_sets = [set(etran_requests.parse_car_numbers(part.query)) for part in parts]
+        etran_response = await loop.run_in_executor(
+            decode_executor,
+            etran_requests.decode_wagon_response,
+            response_packet.body,
+            wagon_sets,
+            config.DECODE_STREAMING,
+        )
+    else:
+        decoder = etran_requests.decode_response_stream if config.DECODE_STREAMING else etran_requests.decode_response
+        etran_response = await loop.run_in_executor(decode_executor, decoder, response_packet.body)
+
+    metrics.decode_time.observe(time.monotonic() - start_time, response_packet.request_packet.request_type)
+    return etran_response
+
+
+def create_etran_session() -> aiohttp.ClientSession:
+    """Создаёт общую для всех воркеров HTTP-сессию ЭТРАН с пулом соединений"""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=config.ETRAN_POOL_SIZE,
+            limit_per_host=config.ETRAN_POOL_PER_HOST,
+            keepalive_timeout=config.ETRAN_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+        ),
+        timeout=aiohttp.ClientTimeout(total=config.REQUEST_TIMEOUT),
+        headers={"Accept-Encoding": config.ETRAN_ACCEPT_ENCODING},
+        raise_for_status=True,
+        trace_configs=[http_stats.trace_config()],
+    )
 
-            if isinstance(e, pyodbc.Error):
-                raise_on_pyodbc_disconnect(e)
 
-        # задачу нужно завершить при любом, даже неудачном исходе, иначе join() повиснет
-        queue_out.task_done()
+def create_metrics(queue_in, queue_out, queue_db, queue_batch, in_flight) -> ETRANMetrics:
+    """Создаёт метрики сервиса, включая показатели очередей, ограничителя, автомата защиты, кэша и пула соединений"""
+    metrics = ETRANMetrics()
+    queues = {"in": queue_in, "out": queue_out, "db": queue_db, "batch": queue_batch}
+    metrics.add(
+        CallbackGauge(
+            "etran_queue_size",
+            "Длина внутренних очередей",
+            lambda: {**{(name,): queue.qsize() for name, queue in queues.items()}, ("retry",): len(retry_queue)},
+            ("queue",),
+        )
+    )
+    metrics.add(CallbackGauge("etran_distinct_requests", "Различные запросы в работе", lambda: len(in_flight)))
+    metrics.add(
+        CallbackGauge(
+            "etran_concurrency_limit", "Предел параллельных запросов к ЭТРАН", lambda: int(concurrency_limiter.limit)
+        )
+    )
+    metrics.add(
+        CallbackGauge(
+            "etran_breaker_state",
+            "Состояние автомата защиты (1 - текущее)",
+            lambda: {(state,): int(circuit_breaker.state == state) for state in (CLOSED, OPEN, HALF_OPEN)},
+            ("state",),
+        )
+    )
+    metrics.add(
+        CallbackGauge(
+            "etran_breaker_transitions_total",
+            "Смены состояния автомата защиты",
+            lambda: dict(circuit_breaker.transitions),
+            ("from", "to"),
+            type="counter",
+        )
+    )
+    metrics.add(
+        CallbackGauge(
+            "etran_cache_total",
+            "Обращения к кэшу ответов",
+            lambda: {(result,): response_cache.stats()[result] for result in ("hits", "misses", "evictions")},
+            ("result",),
+            type="counter",
+        )
+    )
+    metrics.add(
+        CallbackGauge(
+            "etran_http_connections_total",
+            "Соединения с ЭТРАН: новые (рукопожатия) и повторно использованные",
+            lambda: {(event,): http_stats.counters[event] for event in ("handshakes", "reused", "queued")},
+            ("event",),
+            type="counter",
+        )
+    )
+    metrics.add(
+        CallbackGauge(
+            "etran_queue_bytes",
+            "Байты ответов ЭТРАН (out) и текстов результатов (db) в памяти",
+            lambda: {(queue,): size for queue, size in byte_budget.used.items()},
+            ("queue",),
+        )
+    )
+    metrics.add(
+        CallbackGauge(
+            "etran_backpressure_paused",
+            "1, если воркеры остановлены из-за превышения BYTE_BUDGET",
+            lambda: int(byte_budget.paused),
+        )
+    )
+    metrics.add(
+        CallbackGauge(
+            "etran_login_in_flight",
+            "Отправленные и ещё не получившие ответа запросы по учётным записям ЭТРАН",
+            lambda: {(name,): login.in_flight for name, login in login_pool.logins.items()},
+            ("login",),
+        )
+    )
+    if digest_index is not None:
+        metrics.add(
+            CallbackGauge(
+                "etran_unchanged_results_total",
+                "Результаты, записанные маркером, потому что ответ не изменился",
+                lambda: digest_index.unchanged,
+                type="counter",
+            )
+        )
+    if spool is not None:
+        metrics.add(
+            CallbackGauge("etran_spool_results", "Результаты в spool, ещё не записанные в БД", lambda: len(spool))
+        )
+    return metrics
+
+
+def ignore_stop_signals():
+    """Инициализатор процессов пула декодирования: игнорирует сигналы остановки"""
+    # SIGINT и SIGTERM может получить вся группа процессов, а пул останавливает основной процесс после drain;
+    # унаследованный wakeup fd сбрасываем, иначе сигнал дочернему процессу выглядел бы для основного повторным
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def create_decode_executor():
+    """Создаёт пул для декодирования ответов ЭТРАН"""
+    if config.DECODE_EXECUTOR == "process":
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=config.DECODE_WORKERS, initializer=ignore_stop_signals
+        )
+    elif config.DECODE_EXECUTOR == "thread":
+        # lxml отпускает GIL при разборе, поэтому потоки тоже дают параллелизм
+        return concurrent.futures.ThreadPoolExecutor(max_workers=config.DECODE_WORKERS, thread_name_prefix="decode")
+    else:
+        raise ValueError(f"Неизвестный тип пула декодирования: {config.DECODE_EXECUTOR}")
 
 
-def raise_on_pyodbc_disconnect(exc: pyodbc.Error):
+def raise_on_disconnect(store: QueueStore, exc: Exception):
     """Проверяет, вызвана ли ошибка БД разрывом соединения, и запрашивает реконнект"""
-    if exc.args[0] == "The cursor's connection has been closed.":
+    if store.is_disconnect(exc):
         raise
 
 
+def create_queue_store() -> QueueStore:
+    """Создаёт ещё не открытое соединение с хранилищем очереди запросов"""
+    lease = (config.INSTANCE_ID, config.LEASE_TIME)
+    if config.QUEUE_STORE == "odbc":
+        return ODBCQueueStore(config.DB_CONNECTION_STRING, config.DB_BULK_PROCEDURE, *lease)
+    elif config.QUEUE_STORE == "sqlite":
+        return SQLiteQueueStore(config.QUEUE_STORE_PATH, *lease)
+    elif config.QUEUE_STORE == "memory":
+        return MemoryQueueStore(memory_queue, *lease)
+    elif config.QUEUE_STORE == "file":
+        return FileQueueStore(file_queue, *lease)
+    else:
+        raise ValueError(f"Неизвестное хранилище очереди: {config.QUEUE_STORE}")
+
+
 async def db_runner(coro, *args, **kwargs):
     """Обёртка для корутин с (пере)подключением к БД"""
     while True:
+        store = create_queue_store()
         try:
-            db_conn = await aioodbc.connect(dsn=config.DB_CONNECTION_STRING, autocommit=True)
-            db_cursor = await db_conn.cursor()
+            await store.open()
             need_close = True
 
-            await coro(db_cursor, *args, **kwargs)
+            await coro(store, *args, **kwargs)
 
-        except pyodbc.Error as e:
+        except store.Error as e:
             # перезапускаем корутину, если соединение с БД прервалось
             need_close = False
             logging.warning(f"rerunning {coro.__name__} after {config.SLEEP_ON_DISCONNECT}s sleep because of {repr(e)}")
@@ -223,49 +822,116 @@ async def db_runner(coro, *args, **kwargs):
         finally:
             # не пытаемся закрыть прерванное соединение
             if need_close:
-                await db_cursor.close()
-                await db_conn.close()
+                await store.close()
 
 
-def decode_response_packet(response_packet: ResponsePacket):
-    """Разбирает ResponsePacket и определяет необходимость возврата в очередь"""
-    global etran_is_down
-
+def decode_response_packet(response_packet: ResponsePacket, etran_response: etran_requests.ETRANResponse):
+    """Разбирает ResponsePacket и декодированный ответ, определяет необходимость возврата в очередь"""
     request_id = response_packet.request_id
     if response_is_error := response_packet.is_error:
         # ошибка напрямую из producer'а
         response_text = response_packet.body.decode()
     else:
-        # декодируем ответ
-        etran_response = etran_requests.decode_response(response_packet.body)
         response_is_error = etran_response.is_error
         response_text = etran_response.text
 
     if response_is_error and response_text.startswith("504"):
         # возвращаем запрос в очередь и приостанавливаем обработку новых в случае остановки ЭТРАН
-        etran_is_down, return_to_queue = True, True
+        return_to_queue, outcome = True, "outage"
+        concurrency_limiter.on_failure("outage")
+        circuit_breaker.on_failure("outage")
     elif (
         response_is_error
         and response_packet.request_packet is not None
         and response_text.startswith("400 Дождитесь окончания предыдущего запроса")
     ):
         # возвращаем запрос в очередь в случае ошибки отказа в обслуживании
-        etran_is_down, return_to_queue = False, True
+        return_to_queue, outcome = True, "dos"
         response_packet.request_packet.dos_counter += 1
+        login_pool.on_dos(response_packet.request_packet.login)
+        concurrency_limiter.on_failure("dos")
+        circuit_breaker.on_success()
     else:
         # записываем ответ в БД
-        etran_is_down, return_to_queue = False, False
+        return_to_queue, outcome = False, "error" if response_is_error else "ok"
+        if response_packet.request_packet is not None:
+            circuit_breaker.on_success()
+            login_pool.on_success(response_packet.request_packet.login)
         if not response_text.startswith("<"):
             response_text = f"<root>{response_text}</root>"
 
-    return (return_to_queue, request_id, response_is_error, response_text)
+    if response_packet.request_packet is not None:
+        metrics.outcomes.inc(response_packet.request_packet.request_type, outcome)
+
+    return (return_to_queue, request_id, response_is_error, response_text, outcome)
+
+
+async def replay_spool():
+    """Дописывает в БД результаты, оставшиеся в spool с прошлого запуска"""
+    if spool is None or not len(spool):
+        return
+
+    store = create_queue_store()
+    await store.open()
+    try:
+        written, after = 0, -1
+        while rows := await spool.pending(config.DB_BATCH_SIZE, after):
+            after = rows[-1][0]
+            batch = [ResultPacket(*row) for row in rows]
+            failed_ids = {result_packet.request_id for result_packet in await write_results(store, batch, "replay")}
+            written_ids = [row[0] for row in rows if row[0] not in failed_ids]
+            # не записавшиеся остаются в spool и будут записаны, когда запрос снова придёт из очереди
+            await spool.remove(written_ids)
+            written += len(written_ids)
+        logging.warning(f"replay wrote {written} spooled results, {len(spool)} left in spool")
+    finally:
+        await store.close()
 
 
 async def reset_db_queue():
-    """Сбрасывает статусы в БД всем ранее взятым, но не обработанным записям"""
-    async with aioodbc.connect(dsn=config.DB_CONNECTION_STRING, autocommit=True) as db_conn:
-        async with db_conn.cursor() as db_cursor:
-            await db_cursor.execute("EXEC etran.ResetProcessingQueue")
+    """Сбрасывает статусы в БД ранее взятым, но не обработанным записям"""
+    store = create_queue_store()
+    await store.open()
+    try:
+        # при аренде - только записи этого экземпляра и записи с просроченной арендой
+        await store.reset()
+    finally:
+        await store.close()
+
+
+async def taker_db(store, queue_take):
+    """Помечает в БД взятыми запросы, пришедшие через /enqueue, чтобы опрос БД не взял их повторно"""
+    task_name = "taker"
+
+    while True:
+        # вызовы /enqueue, пришедшие во время обращения к БД, обслуживаются следующим обращением вместе
+        batch = [await queue_take.get()]
+        while not queue_take.empty():
+            batch.append(queue_take.get_nowait())
+        # номер, переданный несколькими вызовами сразу, достаётся первому из них
+        owners = {}
+        for request_ids, future in batch:
+            for request_id in request_ids:
+                owners.setdefault(request_id, future)
+        try:
+            taken_ids = set(await store.take_requests(list(owners)))
+            for request_ids, future in batch:
+                if not future.done():
+                    taken = [request_id for request_id in request_ids if request_id in taken_ids]
+                    future.set_result([request_id for request_id in taken if owners[request_id] is future])
+
+        except Exception as e:
+            logging.error(f"{task_name} {repr(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+            if isinstance(e, store.Error):
+                raise_on_disconnect(store, e)
+
+        finally:
+            for _, future in batch:
+                future.cancel()
 
 
 async def init_web_server():
@@ -283,6 +949,105 @@ async def web_handler(request):
     if request.path == "/wakeup":
         logging.info("waking up the producer")
         db_polling_sleep.cancel_all()
+
+    # текущий предел параллельных запросов к ЭТРАН и сигналы, по которым он меняется
+    elif request.path == "/limiter":
+        return web.json_response(concurrency_limiter.stats())
+
+    # метрики в текстовом формате Prometheus
+    elif request.path == "/metrics":
+        # content_type с параметром version не принимается aiohttp отдельно, поэтому заголовок задаётся целиком
+        return web.Response(
+            body=metrics.render().encode(), headers={"Content-Type": f"{metrics.content_type}; charset=utf-8"}
+        )
+
+    # пул соединений с ЭТРАН: рукопожатия, повторное использование, время запросов по новым и старым соединениям
+    elif request.path == "/http":
+        return web.json_response(http_stats.stats())
+
+    # состояние автомата защиты от остановки ЭТРАН
+    elif request.path == "/breaker":
+        return web.json_response(circuit_breaker.stats())
+
+    # байты в очередях ответов и результатов, пороги остановки воркеров
+    elif request.path == "/budget":
+        return web.json_response(byte_budget.stats())
+
+    # ответы, записанные маркером вместо текста, потому что не изменились
+    elif request.path == "/digests" and digest_index is not None:
+        return web.json_response(digest_index.stats())
+
+    # подочереди планировщика по типам запросов
+    elif request.path == "/scheduler":
+        return web.json_response(scheduler.stats())
+
+    # учётные записи ЭТРАН: нагрузка, пауза после отказа в обслуживании, исходы
+    elif request.path == "/logins":
+        return web.json_response(login_pool.stats())
+
+    # приём запросов без ожидания опроса БД: {"id", "type", "priority", "query"} или их список; запросы,
+    # требующие быстрого ответа, идут сразу в queue_in, минуя объединение запросов по вагонам
+    elif request.path == "/enqueue" and request.method == "POST":
+        if stopping.is_set():
+            return web.Response(status=503, text="stopping")
+        try:
+            items = await request.json()
+            if isinstance(items, dict):
+                items = [items]
+            requests = [
+                (int(item["id"]), int(item["type"]), int(item.get("priority", 0)), str(item["query"])) for item in items
+            ]
+        except (ValueError, KeyError, TypeError) as e:
+            return web.Response(status=400, text=repr(e))
+        try:
+            taken = asyncio.get_running_loop().create_future()
+            queue_take.put_nowait(([request_id for request_id, *_ in requests], taken))
+            taken_ids = set(await taken)
+        except Exception as e:
+            logging.error(f"enqueue {repr(e)}")
+            return web.Response(status=503, text=repr(e))
+        outcomes = {}
+        for request_id, *rest in requests:
+            if request_id in taken_ids:
+                outcomes[request_id] = await intake(request_id, *rest, "enqueue", batch=False)
+            else:
+                # уже взят из БД этим или другим экземпляром, обработан или отсутствует в очереди
+                outcomes[request_id] = "taken"
+        return web.json_response(outcomes)
+
+    # запросы, ожидающие повтора
+    elif request.path == "/retries":
+        return web.json_response(
+            [
+                {
+                    "id": request_packet.request_id,
+                    "retry_in": round(retry_in, 3),
+                    "dos_counter": request_packet.dos_counter,
+                }
+                for retry_in, request_packet in retry_queue.snapshot()
+            ]
+        )
+
+    # статистика кэша ответов
+    elif request.path == "/cache":
+        return web.json_response(response_cache.stats())
+
+    # сброс кэша, только POST: всего, по типу (?type=) или конкретного запроса (?type=&query=)
+    elif request.path == "/cache/invalidate":
+        if request.method != "POST":
+            return web.Response(status=405, text="POST only", headers={"Allow": "POST"})
+        request_type, request_body = request.query.get("type"), None
+        try:
+            if request_type is not None:
+                request_type = int(request_type)
+                if "query" in request.query:
+                    request_body = etran_requests.request_map[request_type](request.query["query"])
+        except (ValueError, KeyError) as e:
+            return web.Response(status=400, text=repr(e))
+        count = await response_cache.invalidate(request_type, request_body)
+        logging.info(f"cache invalidated type={request_type} query={request.query.get('query')} count={count}")
+        return web.json_response({"invalidated": count})
+
     return web.Response(text="OK")
 
 
@@ -299,33 +1064,158 @@ async def heartbeat():
         await asyncio.sleep(config.HEARTBEAT_INTERVAL)
 
 
-def signal_handler(sig, frame):
-    """Обрабатывает Ctrl+C"""
+def stop_handler():
+    """Обрабатывает SIGINT и SIGTERM: первый сигнал запускает плавную остановку, повторный прерывает её"""
+    if stopping.is_set():
+        logging.warning("stopping immediately")
+        raise KeyboardInterrupt
+    logging.warning("stopping: draining in-flight requests")
+    stopping.set()
+
+
+async def drain(tasks: dict, queue_in, queue_out, queue_db):
+    """Плавная остановка: перестаёт брать запросы, дожидается отправленных и записывает полученные ответы"""
+    logging.warning(
+        f"drain: {len(sending)} requests in flight, {queue_out.qsize()} responses and {queue_db.qsize()} results queued"
+    )
+
+    # новые запросы не берутся ни из БД, ни из очередей
     db_polling_sleep.terminate = True
-    raise KeyboardInterrupt
+    for task in tasks["intake"]:
+        task.cancel()
+    for task in tasks["workers"]:
+        if task not in sending:
+            task.cancel()
+
+    # отправленным запросам и затем декодированию и записи ответов отводится по DRAIN_TIMEOUT;
+    # не отправленные запросы остаются взятыми в БД, их освободит reset_db_queue
+    if busy := [task for task in tasks["workers"] if not task.done()]:
+        _, pending = await asyncio.wait(busy, timeout=config.DRAIN_TIMEOUT)
+        if pending:
+            logging.warning(f"drain: abandoning {len(pending)} requests in flight")
+        for task in pending:
+            task.cancel()
+
+    deadline = time.monotonic() + config.DRAIN_TIMEOUT
+    for name, queue in (("responses", queue_out), ("results", queue_db)):
+        try:
+            await asyncio.wait_for(queue.join(), max(deadline - time.monotonic(), 0.001))
+        except asyncio.TimeoutError:
+            logging.warning(f"drain: {queue.qsize()} {name} left unwritten")
+            break
+
+    logging.warning("drain finished")
 
 
 async def main():
     """Точка входа"""
-    global etran_is_down
     global db_polling_sleep
+    global response_cache
+    global concurrency_limiter
+    global retry_queue
+    global circuit_breaker
+    global http_stats
+    global metrics
+    global intake
+    global spool
+    global login_pool
+    global scheduler
+    global byte_budget
+    global trace_sink
+    global digest_index
+    global stopping
+    global sending
+    global queue_take
+
+    spool = Spool(config.SPOOL_PATH) if config.SPOOL_PATH else None
+    digest_index = (
+        DigestIndex(config.DIGEST_PATH, config.DIGEST_TYPES, config.DIGEST_MAX_AGE) if config.DIGEST_PATH else None
+    )
+    response_cache = ResponseCache(config.CACHE_TTL, config.CACHE_MAX_ENTRIES, config.CACHE_PATH)
+    retry_queue = utils.DelayQueue()
+    http_stats = HTTPStats()
+    circuit_breaker = CircuitBreaker(config.BREAKER_THRESHOLDS, config.BREAKER_OPEN_TIME)
+    trace_sink = TraceSink(config.TRACE_PATH, config.TRACE_SLOW, config.TRACE_SLOW_DEFAULT)
+    byte_budget = ByteBudget(config.BYTE_BUDGET, config.BYTE_BUDGET_LOW)
+    login_pool = LoginPool(
+        config.ETRAN_CREDENTIALS, config.ETRAN_LOGIN_CONCURRENCY, config.SLEEP_ON_DOS, config.SLEEP_ON_DOS_MAX
+    )
+    concurrency_limiter = AdaptiveLimiter(
+        config.WORKERS_COUNT,
+        config.CONCURRENCY_MIN,
+        config.CONCURRENCY_MAX,
+        config.CONCURRENCY_BACKOFF,
+        config.CONCURRENCY_LATENCY_TOLERANCE,
+    )
+
+    queue_in = scheduler = FairQueue(
+        config.QUEUE_MAXSIZE,
+        config.SCHEDULER_WEIGHTS,
+        config.SCHEDULER_CAPS,
+        config.SCHEDULER_DEADLINES,
+        config.SCHEDULER_AGING,
+    )
+    queue_out = asyncio.Queue()
+    queue_db = asyncio.Queue()
+    queue_batch = asyncio.Queue()
+    # вызовы /enqueue, ожидающие пометки запросов взятыми в БД: (номера, future со взятыми этим вызовом номерами)
+    queue_take = asyncio.Queue()
+    # запросы в работе по телу запроса, для объединения одинаковых
+    in_flight = {}
+
+    metrics = create_metrics(queue_in, queue_out, queue_db, queue_batch, in_flight)
+    intake = functools.partial(intake_request, queue_in, queue_out, queue_db, queue_batch, in_flight)
 
     await init_web_server()
+    # до сброса взятых записей, чтобы уже полученные ответы не запрашивались повторно
+    await replay_spool()
     await reset_db_queue()
 
-    etran_is_down = False
     db_polling_sleep = utils.CancellableSleep()
-    signal.signal(signal.SIGINT, signal_handler)
-
-    queue_in = asyncio.PriorityQueue(maxsize=config.QUEUE_MAXSIZE)
-    queue_out = asyncio.Queue()
+    stopping = asyncio.Event()
+    # воркеры, у которых запрос к ЭТРАН в процессе отправки
+    sending = set()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_handler)
+
+    async with create_etran_session() as session:
+        tasks = {
+            "intake": [
+                asyncio.create_task(db_runner(producer_db, queue_in, queue_out, queue_db, queue_batch, in_flight)),
+                asyncio.create_task(batcher(queue_batch, queue_in)),
+                asyncio.create_task(retry_queue.run(queue_in)),
+                asyncio.create_task(db_runner(taker_db, queue_take)),
+            ],
+            "workers": [
+                asyncio.create_task(worker(session, queue_in, queue_out), name=f"worker-{i+1}")
+                for i in range(config.CONCURRENCY_MAX)
+            ],
+            "consumer": [asyncio.create_task(consumer_db(queue_out, queue_db, in_flight))],
+            "writers": [
+                asyncio.create_task(db_runner(writer_db, queue_db), name=f"writer-{i+1}")
+                for i in range(config.DB_WRITERS)
+            ],
+            # сторожевой таймер и аренда нужны до конца остановки
+            "service": [
+                asyncio.create_task(heartbeat()),
+                *([asyncio.create_task(db_runner(lease_keeper))] if config.LEASE_TIME else []),
+            ],
+        }
+        running = asyncio.gather(*(task for group in tasks.values() for task in group))
+        stop_requested = asyncio.create_task(stopping.wait())
+        try:
+            await asyncio.wait({running, stop_requested}, return_when=asyncio.FIRST_COMPLETED)
+            if running.done():
+                running.result()
+            await drain(tasks, queue_in, queue_out, queue_db)
+        finally:
+            stop_requested.cancel()
+            running.cancel()
+            await asyncio.gather(running, return_exceptions=True)
 
-    await asyncio.gather(
-        asyncio.create_task(db_runner(producer_db, queue_in, queue_out)),
-        asyncio.create_task(db_runner(consumer_db, queue_in, queue_out)),
-        asyncio.create_task(heartbeat()),
-        *(asyncio.create_task(worker(queue_in, queue_out), name=f"worker-{i+1}") for i in range(config.WORKERS_COUNT)),
-    )
+    # освобождаем запросы, которые так и не были выполнены
+    await reset_db_queue()
 
 
 if __name__ == "__main__":
@@ -341,6 +1231,7 @@ if __name__ == "__main__":
     try:
         logging.warning("app start")
         asyncio.run(main())
+        logging.warning("app stop")
     except KeyboardInterrupt:
         logging.warning("KeyboardInterrupt")
     except Exception as e:
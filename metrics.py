@@ -0,0 +1,168 @@
+import bisect
+import collections
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name: str, labels: dict, value) -> str:
+    """Строка метрики в текстовом формате Prometheus"""
+    if labels:
+        name += "{" + ",".join(f'{label}="{escape_label(label_value)}"' for label, label_value in labels.items()) + "}"
+    return f"{name} {value}"
+
+
+class Counter:
+    """Счётчик с метками; значения меток передаются позиционно в порядке labelnames"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = collections.Counter()
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            yield self.name, dict(zip(self.labelnames, label_values)), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, *label_values, value):
+        self.values[label_values] = value
+
+    def dec(self, *label_values, amount=1):
+        self.values[label_values] -= amount
+
+
+class CallbackGauge:
+    """Метрика, значение которой при каждом запросе берётся из callback
+
+    callback возвращает число или словарь {кортеж значений меток: число}.
+    """
+
+    def __init__(self, name: str, help: str, callback, labelnames: tuple = (), type: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = labelnames
+        self.type = type
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name, dict(zip(self.labelnames, label_values)), value if value is not None else 0
+
+
+class Histogram:
+    """Гистограмма с метками и фиксированными границами корзин"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.labelnames = labelnames
+        # значения меток -> [попадания в корзины (последняя - +Inf), сумма]
+        self.values = {}
+
+    def observe(self, value: float, *label_values):
+        if (entry := self.values.get(label_values)) is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for label_values, (counts, total) in sorted(self.values.items(), key=lambda item: str(item[0])):
+            labels = dict(zip(self.labelnames, label_values))
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": bound}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    """Набор метрик, отдаваемый эндпоинтом /metrics"""
+
+    content_type = "text/plain; version=0.0.4"
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(format_sample(*sample) for sample in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class ETRANMetrics(Registry):
+    """Метрики сервиса: ожидание, задержки ЭТРАН, декодирования и записи в БД по типам запросов, исходы, объём ответов
+
+    Состояние очередей, ограничителя, автомата защиты и кэша добавляется через CallbackGauge.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.etran_latency = self.add(
+            Histogram(
+                "etran_request_duration_seconds",
+                "Время HTTP-запроса к ЭТРАН",
+                (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+                ("type",),
+            )
+        )
+        self.queue_wait = self.add(
+            Histogram(
+                "etran_queue_wait_seconds",
+                "Время от поступления запроса до его отправки в ЭТРАН, включая повторы",
+                (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+                ("type",),
+            )
+        )
+        self.decode_time = self.add(
+            Histogram(
+                "etran_decode_duration_seconds",
+                "Время декодирования ответа ЭТРАН, включая ожидание в пуле",
+                (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+                ("type",),
+            )
+        )
+        self.db_write_time = self.add(
+            Histogram(
+                "etran_db_write_duration_seconds",
+                "Время записи результата в БД (доля времени записи пачки на одну строку)",
+                (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+                ("type",),
+            )
+        )
+        self.outcomes = self.add(
+            Counter(
+                "etran_requests_total",
+                "Исходы запросов к ЭТРАН: ok, error, dos, outage (504), timeout, network",
+                ("type", "outcome"),
+            )
+        )
+        self.bytes_received = self.add(
+            Counter("etran_response_bytes_total", "Объём тел ответов ЭТРАН после распаковки HTTP", ("type",))
+        )
+        self.in_flight = self.add(Gauge("etran_requests_in_flight", "HTTP-запросы к ЭТРАН в процессе отправки"))
+        self.in_flight.set(value=0)
@@ -0,0 +1,594 @@
+import asyncio
+import heapq
+import json
+import math
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+try:
+    import aioodbc
+    import pyodbc
+except ImportError:
+    aioodbc = pyodbc = None
+
+# запрос из очереди; у строк pyodbc те же атрибуты
+Request = namedtuple("Request", "ID TypeID Priority Query")
+
+NEW, TAKEN, DONE = 0, 1, 2
+
+
+class QueueStoreError(Exception):
+    pass
+
+
+class QueueStore:
+    """Соединение с очередью запросов
+
+    Семантика повторяет процедуры etran.* в БД: get_requests берёт до max_count новых запросов по возрастанию
+    Priority, а при равном приоритете - в порядке поступления, и помечает их взятыми в работу; take_requests
+    так же помечает взятыми новые запросы с заданными номерами, пришедшие через /enqueue; set_response(s)
+    записывает окончательный результат ещё не обработанного запроса, в том числе не взятого; reset возвращает
+    в очередь все взятые, но не обработанные запросы. Каждая корутина работает
+    со своим соединением; ошибки класса Error, для которых is_disconnect возвращает True, означают разрыв
+    соединения и требуют переподключения.
+
+    С lease_time > 0 несколько экземпляров сервиса работают с одной очередью: запросы берутся в аренду на
+    lease_time секунд от имени instance_id, аренда продлевается renew_leases, reset возвращает в очередь только
+    свои и просроченные запросы, а reclaim_expired - запросы, аренду которых перестал продлевать упавший экземпляр.
+    """
+
+    Error = QueueStoreError
+
+    def __init__(self, instance_id: str = None, lease_time: float = 0):
+        self.instance_id = instance_id
+        self.lease_time = lease_time
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get_requests(self, max_count: int) -> list:
+        raise NotImplementedError
+
+    async def take_requests(self, request_ids: list[int]) -> list[int]:
+        """Помечает взятыми в работу новые запросы с номерами request_ids; возвращает номера взятых
+
+        Уже взятые, в том числе другим экземпляром, обработанные и отсутствующие в очереди номера не возвращаются.
+        """
+        raise NotImplementedError
+
+    async def set_responses(self, rows: list[tuple]):
+        """Записывает результаты (RequestID, IsError, Response) одним обращением"""
+        for row in rows:
+            await self.set_response(*row)
+
+    async def set_response(self, request_id: int, is_error: bool, text: str):
+        raise NotImplementedError
+
+    async def reset(self):
+        raise NotImplementedError
+
+    async def renew_leases(self) -> int:
+        """Продлевает аренду всех взятых этим экземпляром запросов; возвращает их число"""
+        raise NotImplementedError
+
+    async def reclaim_expired(self) -> int:
+        """Возвращает в очередь запросы с просроченной арендой; возвращает их число"""
+        raise NotImplementedError
+
+    def is_disconnect(self, exc: Exception) -> bool:
+        return False
+
+
+class ODBCQueueStore(QueueStore):
+    """Очередь в SQL Server: процедуры etran.GetRequestQueue, etran.SetRequestResponse, etran.ResetProcessingQueue
+
+    Аренда требует параметров @InstanceID и @LeaseTime у etran.GetRequestQueue и etran.ResetProcessingQueue
+    и процедур etran.RenewRequestLeases и etran.ReclaimExpiredRequests. /enqueue требует процедуры
+    etran.TakeRequests с табличным параметром @RequestIDs (столбец RequestID), @InstanceID и @LeaseTime,
+    возвращающей номера взятых запросов.
+    """
+
+    def __init__(self, dsn: str, bulk_procedure: str = None, instance_id: str = None, lease_time: float = 0):
+        super().__init__(instance_id, lease_time)
+        self.dsn = dsn
+        # процедура пакетной записи результатов с табличным параметром @Responses; без неё - executemany
+        self.bulk_procedure = bulk_procedure
+        self.db_conn = None
+        self.db_cursor = None
+
+    @property
+    def Error(self):
+        return pyodbc.Error
+
+    async def open(self):
+        self.db_conn = await aioodbc.connect(dsn=self.dsn, autocommit=True)
+        self.db_cursor = await self.db_conn.cursor()
+
+    async def close(self):
+        await self.db_cursor.close()
+        await self.db_conn.close()
+
+    async def get_requests(self, max_count: int) -> list:
+        if self.lease_time:
+            await self.db_cursor.execute(
+                "EXEC etran.GetRequestQueue @MaxCount=?, @InstanceID=?, @LeaseTime=?",
+                max_count,
+                self.instance_id,
+                self.lease_time,
+            )
+        else:
+            await self.db_cursor.execute("EXEC etran.GetRequestQueue @MaxCount=?", max_count)
+        return await self.db_cursor.fetchall()
+
+    async def take_requests(self, request_ids: list[int]) -> list[int]:
+        await self.db_cursor.execute(
+            "EXEC etran.TakeRequests @RequestIDs=?, @InstanceID=?, @LeaseTime=?",
+            [(request_id,) for request_id in request_ids],
+            self.instance_id,
+            self.lease_time,
+        )
+        return [row[0] for row in await self.db_cursor.fetchall()]
+
+    async def set_responses(self, rows: list[tuple]):
+        if self.bulk_procedure:
+            # табличный параметр со столбцами (RequestID, IsError, Response) - один параметр, значение которого
+            # список строк; без кортежа pyodbc принял бы каждую строку за отдельный параметр
+            await self.db_cursor.execute(f"EXEC {self.bulk_procedure} @Responses=?", (rows,))
+        else:
+            await self.db_cursor.executemany(
+                "EXEC etran.SetRequestResponse @RequestID=?, @IsError=?, @Response=?", rows
+            )
+
+    async def set_response(self, request_id: int, is_error: bool, text: str):
+        await self.db_cursor.execute(
+            "EXEC etran.SetRequestResponse @RequestID=?, @IsError=?, @Response=?", request_id, is_error, text
+        )
+
+    async def reset(self):
+        if self.lease_time:
+            await self.db_cursor.execute("EXEC etran.ResetProcessingQueue @InstanceID=?", self.instance_id)
+        else:
+            await self.db_cursor.execute("EXEC etran.ResetProcessingQueue")
+
+    async def renew_leases(self) -> int:
+        await self.db_cursor.execute(
+            "EXEC etran.RenewRequestLeases @InstanceID=?, @LeaseTime=?", self.instance_id, self.lease_time
+        )
+        return (await self.db_cursor.fetchone())[0]
+
+    async def reclaim_expired(self) -> int:
+        await self.db_cursor.execute("EXEC etran.ReclaimExpiredRequests")
+        return (await self.db_cursor.fetchone())[0]
+
+    def is_disconnect(self, exc: Exception) -> bool:
+        return exc.args[0] == "The cursor's connection has been closed."
+
+
+class SQLiteQueueStore(QueueStore):
+    """Очередь в файле SQLite для локального запуска без SQL Server
+
+    Таблица requests создаётся при первом подключении; запросы добавляются через add_requests или вставкой
+    строк (TypeID, Priority, Query) напрямую. Обращения к SQLite синхронные и короткие, как в кэше ответов.
+    Файл могут одновременно использовать несколько процессов.
+    """
+
+    Error = sqlite3.Error
+
+    def __init__(self, path: str, instance_id: str = None, lease_time: float = 0):
+        super().__init__(instance_id, lease_time)
+        self.path = path
+        self.db = None
+
+    async def open(self):
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS requests (ID INTEGER PRIMARY KEY AUTOINCREMENT, TypeID INTEGER, "
+            f"Priority INTEGER, Query TEXT, Status INTEGER DEFAULT {NEW}, "
+            "Available REAL DEFAULT ((julianday('now') - 2440587.5) * 86400.0), "
+            "Taken REAL, Completed REAL, IsError INTEGER, Response TEXT, Owner TEXT, LeaseExpires REAL)"
+        )
+        # файлы, созданные до появления аренды
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(requests)")}
+        for column, column_type in (("Owner", "TEXT"), ("LeaseExpires", "REAL")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE requests ADD COLUMN {column} {column_type}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS requests_queue ON requests (Status, Priority, ID)")
+
+    async def close(self):
+        self.db.close()
+
+    async def get_requests(self, max_count: int) -> list:
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.db.execute(
+                "SELECT ID, TypeID, Priority, Query FROM requests WHERE Status = ? AND Available <= ? "
+                "ORDER BY Priority, ID LIMIT ?",
+                (NEW, now, max_count),
+            ).fetchall()
+            lease_expires = now + self.lease_time if self.lease_time else None
+            self.db.executemany(
+                "UPDATE requests SET Status = ?, Taken = ?, Owner = ?, LeaseExpires = ? WHERE ID = ?",
+                [(TAKEN, now, self.instance_id, lease_expires, row[0]) for row in rows],
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return [Request(*row) for row in rows]
+
+    async def take_requests(self, request_ids: list[int]) -> list[int]:
+        now = time.time()
+        lease_expires = now + self.lease_time if self.lease_time else None
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            taken = [
+                request_id
+                for request_id in request_ids
+                if self.db.execute(
+                    "UPDATE requests SET Status = ?, Taken = ?, Owner = ?, LeaseExpires = ? "
+                    "WHERE ID = ? AND Status = ?",
+                    (TAKEN, now, self.instance_id, lease_expires, request_id, NEW),
+                ).rowcount
+            ]
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return taken
+
+    async def set_responses(self, rows: list[tuple]):
+        now = time.time()
+        self.db.executemany(
+            "UPDATE requests SET Status = ?, Completed = ?, IsError = ?, Response = ? WHERE ID = ? AND Status != ?",
+            [(DONE, now, is_error, text, request_id, DONE) for request_id, is_error, text in rows],
+        )
+
+    async def set_response(self, request_id: int, is_error: bool, text: str):
+        await self.set_responses([(request_id, is_error, text)])
+
+    async def reset(self):
+        if self.lease_time:
+            self.db.execute(
+                "UPDATE requests SET Status = ? WHERE Status = ? AND (Owner = ? OR LeaseExpires < ?)",
+                (NEW, TAKEN, self.instance_id, time.time()),
+            )
+        else:
+            self.db.execute("UPDATE requests SET Status = ? WHERE Status = ?", (NEW, TAKEN))
+
+    async def renew_leases(self) -> int:
+        return self.db.execute(
+            "UPDATE requests SET LeaseExpires = ? WHERE Status = ? AND Owner = ?",
+            (time.time() + self.lease_time, TAKEN, self.instance_id),
+        ).rowcount
+
+    async def reclaim_expired(self) -> int:
+        return self.db.execute(
+            "UPDATE requests SET Status = ? WHERE Status = ? AND LeaseExpires < ?", (NEW, TAKEN, time.time())
+        ).rowcount
+
+    def is_disconnect(self, exc: Exception) -> bool:
+        return isinstance(exc, sqlite3.ProgrammingError)
+
+    def add_requests(self, requests: list[tuple]):
+        """Добавляет запросы (TypeID, Priority, Query[, Available]) в очередь"""
+        now = time.time()
+        self.db.executemany(
+            "INSERT INTO requests (TypeID, Priority, Query, Available) VALUES (?, ?, ?, ?)",
+            [(*request[:3], request[3] if len(request) > 3 else now) for request in requests],
+        )
+
+    def completed(self) -> list[tuple]:
+        """Обработанные запросы: (ID, IsError, длина ответа, время поступления, время записи результата, владелец)"""
+        return self.db.execute(
+            "SELECT ID, IsError, length(Response), Available, Completed, Owner FROM requests WHERE Status = ?",
+            (DONE,),
+        ).fetchall()
+
+
+class MemoryQueue:
+    """Очередь запросов в памяти процесса, общая для всех соединений MemoryQueueStore"""
+
+    def __init__(self):
+        self.requests = {}
+        self.available = {}
+        # запросы, время поступления которых ещё не наступило: (время, ID)
+        self.scheduled = []
+        # новые запросы: (Priority, ID)
+        self.ready = []
+        # взятые запросы: ID -> (владелец, срок аренды)
+        self.taken = {}
+        # ID -> (IsError, длина ответа, время записи результата, владелец)
+        self.results = {}
+        # имитация задержки обращения к БД, секунд
+        self.latency = 0.0
+
+    def add_requests(self, requests: list[tuple]):
+        """Добавляет запросы (TypeID, Priority, Query[, Available]) в очередь"""
+        now = time.time()
+        for request in requests:
+            request_id = len(self.requests) + 1
+            self.requests[request_id] = Request(request_id, *request[:3])
+            self.available[request_id] = request[3] if len(request) > 3 else now
+            heapq.heappush(self.scheduled, (self.available[request_id], request_id))
+
+    def get_requests(self, max_count: int, owner: str = None, lease_time: float = 0) -> list[Request]:
+        now = time.time()
+        while self.scheduled and self.scheduled[0][0] <= now:
+            _, request_id = heapq.heappop(self.scheduled)
+            heapq.heappush(self.ready, (self.requests[request_id].Priority, request_id))
+
+        requests = []
+        while self.ready and len(requests) < max_count:
+            _, request_id = heapq.heappop(self.ready)
+            if request_id in self.results or request_id in self.taken:
+                # уже обработан или взят через take_requests, минуя очередь
+                continue
+            self.taken[request_id] = (owner, now + lease_time if lease_time else math.inf)
+            requests.append(self.requests[request_id])
+        return requests
+
+    def take_requests(self, request_ids: list[int], owner: str = None, lease_time: float = 0) -> list[int]:
+        expires = time.time() + lease_time if lease_time else math.inf
+        taken = [
+            request_id
+            for request_id in request_ids
+            if request_id in self.requests and request_id not in self.taken and request_id not in self.results
+        ]
+        for request_id in taken:
+            self.taken[request_id] = (owner, expires)
+        return taken
+
+    def set_response(self, request_id: int, is_error: bool, text: str):
+        if request_id in self.requests and request_id not in self.results:
+            owner, _ = self.taken.pop(request_id, (None, None))
+            self.results[request_id] = (bool(is_error), len(text), time.time(), owner)
+
+    def release(self, condition) -> int:
+        """Возвращает в очередь взятые запросы, для (владельца, срока аренды) которых condition истинно"""
+        released = [request_id for request_id, lease in self.taken.items() if condition(*lease)]
+        for request_id in released:
+            del self.taken[request_id]
+            heapq.heappush(self.ready, (self.requests[request_id].Priority, request_id))
+        return len(released)
+
+    def reset(self, owner: str = None, lease_time: float = 0):
+        now = time.time()
+        if lease_time:
+            self.release(lambda request_owner, expires: request_owner == owner or expires < now)
+        else:
+            self.release(lambda request_owner, expires: True)
+
+    def renew(self, owner: str, lease_time: float) -> int:
+        expires = time.time() + lease_time
+        renewed = [request_id for request_id, (request_owner, _) in self.taken.items() if request_owner == owner]
+        for request_id in renewed:
+            self.taken[request_id] = (owner, expires)
+        return len(renewed)
+
+    def reclaim_expired(self) -> int:
+        now = time.time()
+        return self.release(lambda request_owner, expires: expires < now)
+
+    def completed(self) -> list[tuple]:
+        """Обработанные запросы: (ID, IsError, длина ответа, время поступления, время записи результата, владелец)"""
+        return [
+            (request_id, is_error, length, self.available[request_id], completed, owner)
+            for request_id, (is_error, length, completed, owner) in self.results.items()
+        ]
+
+
+# очередь в памяти для хранилища "memory"; наполняется тем, кто запускает main в своём процессе
+memory_queue = MemoryQueue()
+
+
+class MemoryQueueStore(QueueStore):
+    """Очередь в памяти процесса для нагрузочных тестов и профилирования конвейера"""
+
+    def __init__(self, queue: MemoryQueue, instance_id: str = None, lease_time: float = 0):
+        super().__init__(instance_id, lease_time)
+        self.queue = queue
+
+    async def get_requests(self, max_count: int) -> list:
+        await asyncio.sleep(self.queue.latency)
+        return self.queue.get_requests(max_count, self.instance_id, self.lease_time)
+
+    async def take_requests(self, request_ids: list[int]) -> list[int]:
+        await asyncio.sleep(self.queue.latency)
+        return self.queue.take_requests(request_ids, self.instance_id, self.lease_time)
+
+    async def set_responses(self, rows: list[tuple]):
+        await asyncio.sleep(self.queue.latency)
+        for row in rows:
+            self.queue.set_response(*row)
+
+    async def set_response(self, request_id: int, is_error: bool, text: str):
+        await self.set_responses([(request_id, is_error, text)])
+
+    async def reset(self):
+        self.queue.reset(self.instance_id, self.lease_time)
+
+    async def renew_leases(self) -> int:
+        return self.queue.renew(self.instance_id, self.lease_time)
+
+    async def reclaim_expired(self) -> int:
+        return self.queue.reclaim_expired()
+
+
+class FileQueue:
+    """Очередь запросов из файла JSON lines с результатами в другом файле JSON lines, для batch.py
+
+    Строка входного файла - {"type", "query", "priority"} и, необязательно, "id", который переносится
+    в результат; номер запроса - номер строки, пустые строки пропускаются. Строки читаются по мере того,
+    как конвейер берёт запросы, и в памяти одновременно не больше window прочитанных, но не записанных строк.
+    Результат дописывается в выходной файл строкой {"line", "id", "type", "query", "is_error", "response"}.
+
+    После каждой записи сохраняется контрольная точка: смещение первой незаписанной строки, номера записанных
+    строк после неё и длина выходного файла. При повторном запуске выходной файл обрезается до этой длины,
+    а чтение продолжается с первой незаписанной строки, так что каждая строка попадает в результат один раз.
+    Непустой выходной файл без контрольной точки не трогается, если не задан overwrite; с overwrite прогон
+    начинается заново, а выходной файл очищается.
+    """
+
+    def __init__(self, input_path: str, output_path: str, checkpoint_path: str, window: int, overwrite: bool = False):
+        self.checkpoint_path = checkpoint_path
+        self.window = window
+        # все строки до watermark_line включительно записаны, следующая начинается со смещения watermark_offset
+        self.watermark_line, self.watermark_offset, output_size = 0, 0, 0
+        # записанные строки после watermark_line
+        self.done = set()
+        if not overwrite and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, encoding="utf8") as f:
+                checkpoint = json.load(f)
+            self.watermark_line, self.watermark_offset = checkpoint["line"], checkpoint["offset"]
+            self.done = set(checkpoint["done"])
+            output_size = checkpoint["output_size"]
+        elif not overwrite and os.path.exists(output_path) and os.path.getsize(output_path):
+            raise ValueError(f"{output_path} уже содержит результаты, а контрольной точки {checkpoint_path} нет")
+
+        self.input = open(input_path, "rb")
+        self.input.seek(self.watermark_offset)
+        self.line = self.watermark_line
+        self.eof = False
+        self.output = open(output_path, "ab")
+        if self.output.seek(0, os.SEEK_END) < output_size:
+            raise ValueError(f"{output_path} короче, чем при сохранении контрольной точки {checkpoint_path}")
+        self.output.truncate(output_size)
+        self.output.seek(output_size)
+
+        # прочитанные и ещё не вошедшие в watermark строки: номер -> смещение конца строки
+        self.ends = {}
+        # прочитанные и не записанные запросы
+        self.requests = {}
+        self.extra_ids = {}
+        # возвращённые в очередь запросы: (Priority, номер)
+        self.ready = []
+        self.taken = set()
+        self.written = 0
+        self.latency = 0.0
+
+    def read_requests(self, max_count: int) -> list[Request]:
+        """Читает из входного файла до max_count новых запросов"""
+        requests = []
+        while len(requests) < max_count and len(self.ends) < self.window and not self.eof:
+            data = self.input.readline()
+            if not data:
+                self.eof = True
+                break
+            self.line += 1
+            self.ends[self.line] = self.input.tell()
+            if self.line in self.done:
+                # записан до перезапуска
+                self.advance()
+                continue
+            if not data.strip():
+                self.mark_done(self.line)
+                continue
+
+            try:
+                item = json.loads(data)
+                request = Request(self.line, int(item["type"]), int(item.get("priority", 0)), str(item["query"]))
+            except (ValueError, KeyError, TypeError) as e:
+                # некорректную строку записываем ошибкой, чтобы она не пропала из результата незаметно
+                self.requests[self.line] = Request(self.line, None, None, data.decode("utf8", "replace").strip())
+                self.write_result(self.line, True, f"<root>{repr(e)}</root>")
+                continue
+            self.requests[self.line] = request
+            if "id" in item:
+                self.extra_ids[self.line] = item["id"]
+            requests.append(request)
+        return requests
+
+    def get_requests(self, max_count: int, owner: str = None, lease_time: float = 0) -> list[Request]:
+        requests = []
+        while self.ready and len(requests) < max_count:
+            _, line = heapq.heappop(self.ready)
+            if line in self.requests and line not in self.taken:
+                requests.append(self.requests[line])
+        requests += self.read_requests(max_count - len(requests))
+        self.taken.update(request.ID for request in requests)
+        return requests
+
+    def take_requests(self, request_ids: list[int], owner: str = None, lease_time: float = 0) -> list[int]:
+        # взять можно только уже прочитанные строки: остальные придут при чтении файла
+        taken = [line for line in request_ids if line in self.requests and line not in self.taken]
+        self.taken.update(taken)
+        return taken
+
+    def set_response(self, request_id: int, is_error: bool, text: str):
+        if request_id in self.requests:
+            self.write_result(request_id, is_error, text)
+
+    def write_result(self, line: int, is_error: bool, text: str):
+        request = self.requests.pop(line)
+        record = {
+            "line": line,
+            "id": self.extra_ids.pop(line, None),
+            "type": request.TypeID,
+            "query": request.Query,
+            "is_error": bool(is_error),
+            "response": text,
+        }
+        self.output.write(json.dumps(record, ensure_ascii=False).encode("utf8") + b"\n")
+        self.taken.discard(line)
+        self.written += 1
+        self.mark_done(line)
+
+    def mark_done(self, line: int):
+        self.done.add(line)
+        self.advance()
+
+    def advance(self):
+        while self.watermark_line + 1 in self.done and self.watermark_line + 1 in self.ends:
+            self.watermark_line += 1
+            self.done.remove(self.watermark_line)
+            self.watermark_offset = self.ends.pop(self.watermark_line)
+
+    def checkpoint(self):
+        """Сохраняет результаты на диск и контрольную точку после них"""
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        checkpoint = {
+            "line": self.watermark_line,
+            "offset": self.watermark_offset,
+            "done": sorted(self.done),
+            "output_size": self.output.tell(),
+        }
+        with open(self.checkpoint_path + ".tmp", "w", encoding="utf8") as f:
+            json.dump(checkpoint, f)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def reset(self, owner: str = None, lease_time: float = 0):
+        for line in self.taken:
+            heapq.heappush(self.ready, (self.requests[line].Priority, line))
+        self.taken.clear()
+
+    def finished(self) -> bool:
+        """Все строки входного файла прочитаны и записаны"""
+        return self.eof and not self.ends
+
+    def close(self):
+        self.checkpoint()
+        self.input.close()
+        self.output.close()
+
+
+class FileQueueStore(MemoryQueueStore):
+    """Соединение с очередью FileQueue; контрольная точка сохраняется после каждой записи результатов"""
+
+    async def set_responses(self, rows: list[tuple]):
+        await super().set_responses(rows)
+        self.queue.checkpoint()
+
+    async def renew_leases(self) -> int:
+        return 0
+
+    async def reclaim_expired(self) -> int:
+        return 0
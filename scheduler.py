@@ -0,0 +1,147 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import time
+
+
+class _TypeQueue:
+    """Очередь запросов одного типа"""
+
+    def __init__(self, weight: float, cap: int, deadline: float):
+        self.weight = weight
+        self.cap = cap
+        self.deadline = deadline
+        # (приоритет с учётом возраста, время поступления запроса, номер постановки в очередь, запрос)
+        self.heap = []
+        self.running = 0
+        # виртуальное время взвешенного разделения: растёт на 1 / weight с каждым выданным запросом
+        self.pass_ = 0.0
+        self.counters = collections.Counter()
+
+
+class FairQueue:
+    """Очередь запросов к ЭТРАН с раздельными подочередями по типам и взвешенным разделением воркеров
+
+    Запрос выдаётся из подочереди, в которой:
+    - первый запрос просрочил срок своего типа (deadlines, секунд от поступления), самый давний из таких;
+    - иначе - из подочередей с наилучшим приоритетом первого запроса та, что получила меньше всего
+      относительно своего веса (weights, по умолчанию 1).
+    Подочереди, у которых в работе уже caps[тип] запросов, пропускаются. Внутри подочереди запросы идут
+    по приоритету, а с aging > 0 приоритет улучшается на aging за каждую секунду ожидания. Возраст считается
+    от поступления запроса (RequestPacket.created), поэтому возвращённый в очередь запрос не теряет места.
+    Интерфейс повторяет asyncio.Queue, но task_done получает завершённый запрос, чтобы учесть его тип.
+    """
+
+    def __init__(self, maxsize: int, weights: dict, caps: dict, deadlines: dict, aging: float):
+        self.maxsize = maxsize
+        self.weights = weights
+        self.caps = caps
+        self.deadlines = deadlines
+        self.aging = aging
+        self.queues = {}
+        self.size = 0
+        self.counter = itertools.count()
+        # виртуальное время последнего выданного запроса; простаивавшая подочередь начинает с него, а не с нуля
+        self.virtual_time = 0.0
+        # событие срабатывает при каждом изменении и заменяется новым
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def qsize(self) -> int:
+        return self.size
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.size
+
+    def type_queue(self, request_type: int) -> _TypeQueue:
+        if (type_queue := self.queues.get(request_type)) is None:
+            type_queue = self.queues[request_type] = _TypeQueue(
+                self.weights.get(request_type, 1), self.caps.get(request_type), self.deadlines.get(request_type)
+            )
+        return type_queue
+
+    async def put(self, request_packet):
+        while self.full():
+            await self.changed.wait()
+        self.put_nowait(request_packet)
+
+    def put_nowait(self, request_packet):
+        if self.full():
+            raise asyncio.QueueFull
+        type_queue = self.type_queue(request_packet.request_type)
+        if not type_queue.heap:
+            type_queue.pass_ = max(type_queue.pass_, self.virtual_time)
+        # чем старше запрос, тем меньше ключ; сравнение ключей не зависит от момента сравнения. При равном ключе
+        # первым идёт раньше поступивший запрос, так что возвращённый после повтора не уходит в конец
+        key = request_packet.priority + request_packet.created * self.aging
+        heapq.heappush(type_queue.heap, (key, request_packet.created, next(self.counter), request_packet))
+        request_packet.trace.mark("queue_in")
+        type_queue.counters["enqueued"] += 1
+        self.size += 1
+        self.notify()
+
+    def effective_priority(self, request_packet, now: float) -> int:
+        return request_packet.priority - int((now - request_packet.created) * self.aging)
+
+    def select(self) -> _TypeQueue:
+        """Выбирает подочередь, из которой выдать следующий запрос, или None"""
+        now = time.monotonic()
+        eligible = [
+            type_queue
+            for type_queue in self.queues.values()
+            if type_queue.heap and (type_queue.cap is None or type_queue.running < type_queue.cap)
+        ]
+        if not eligible:
+            return None
+
+        overdue = [
+            (type_queue.heap[0][-1].created + type_queue.deadline, type_queue)
+            for type_queue in eligible
+            if type_queue.deadline is not None and type_queue.heap[0][-1].created + type_queue.deadline <= now
+        ]
+        if overdue:
+            type_queue = min(overdue, key=lambda item: item[0])[1]
+            type_queue.counters["overdue"] += 1
+            return type_queue
+
+        priorities = {type_queue: self.effective_priority(type_queue.heap[0][-1], now) for type_queue in eligible}
+        best = min(priorities.values())
+        return min(
+            (type_queue for type_queue in eligible if priorities[type_queue] == best),
+            key=lambda type_queue: type_queue.pass_,
+        )
+
+    async def get(self):
+        while (type_queue := self.select()) is None:
+            await self.changed.wait()
+
+        *_, request_packet = heapq.heappop(type_queue.heap)
+        type_queue.running += 1
+        type_queue.pass_ += 1 / type_queue.weight
+        type_queue.counters["dispatched"] += 1
+        self.virtual_time = type_queue.pass_
+        self.size -= 1
+        self.notify()
+        return request_packet
+
+    def task_done(self, request_packet):
+        """Отмечает завершение работы над запросом, полученным через get"""
+        self.queues[request_packet.request_type].running -= 1
+        self.notify()
+
+    def stats(self) -> dict:
+        return {
+            request_type: {
+                "queued": len(type_queue.heap),
+                "running": type_queue.running,
+                "weight": type_queue.weight,
+                "cap": type_queue.cap,
+                "deadline": type_queue.deadline,
+                **type_queue.counters,
+            }
+            for request_type, type_queue in self.queues.items()
+        }
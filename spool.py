@@ -0,0 +1,132 @@
+import asyncio
+import concurrent.futures
+import logging
+import sqlite3
+import time
+
+
+class Spool:
+    """Журнал готовых, но ещё не записанных в БД результатов в файле SQLite
+
+    Результат попадает в журнал сразу после получения ответа ЭТРАН и удаляется, когда записан в БД. После
+    перезапуска журнал дописывается в БД до сброса взятых записей, так что оплаченные запросы к ЭТРАН не
+    повторяются; при недоступности БД тексты результатов копятся на диске, а в памяти остаются только номера.
+
+    Обращения к SQLite выполняются в отдельном потоке, чтобы запись многомегабайтных текстов не останавливала
+    цикл событий. Результаты, добавленные, пока идёт запись предыдущей пачки, фиксируются следующей пачкой
+    одной транзакцией; add возвращается после фиксации своей пачки. Номера сохранённых результатов хранятся
+    в памяти, так что проверка "номер в spool" не обращается к файлу.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(RequestID INTEGER PRIMARY KEY, IsError INTEGER, Response TEXT, TypeID INTEGER, Created REAL)"
+        )
+        self.ids = {row[0] for row in self.db.execute("SELECT RequestID FROM results")}
+        # один поток: соединение SQLite не используется параллельно, а операции выполняются в порядке вызова
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+        # копящаяся пачка: (строки, future её фиксации) и задача, записывающая пачки
+        self.batch = None
+        self.flusher = None
+        self.added = 0
+        self.removed = 0
+        self.commits = 0
+        logging.info(f"spool opened {path}, {len(self.ids)} results pending")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, request_id: int) -> bool:
+        return request_id in self.ids
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def add(self, rows: list[tuple]):
+        """Сохраняет результаты (RequestID, IsError, Response, TypeID); возвращается, когда они зафиксированы"""
+        if self.batch is None:
+            self.batch = ([], asyncio.get_running_loop().create_future())
+            if self.flusher is None or self.flusher.done():
+                self.flusher = asyncio.create_task(self.flush())
+        batch_rows, committed = self.batch
+        batch_rows.extend(rows)
+        # отмена ожидающего не должна отменять фиксацию пачки, в которой есть чужие результаты
+        await asyncio.shield(committed)
+
+    async def flush(self):
+        while self.batch is not None:
+            (rows, committed), self.batch = self.batch, None
+            try:
+                await self.run(self.insert, rows)
+            except Exception as e:
+                committed.set_exception(e)
+                # исключение получат ожидающие add; если их уже отменили, не пишем его в журнал asyncio
+                committed.exception()
+            else:
+                self.ids.update(row[0] for row in rows)
+                self.added += len(rows)
+                self.commits += 1
+                committed.set_result(None)
+
+    def insert(self, rows: list[tuple]):
+        now = time.time()
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", [(*row, now) for row in rows])
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    async def remove(self, request_ids: list[int]):
+        await self.run(self.delete, request_ids)
+        self.ids.difference_update(request_ids)
+        self.removed += len(request_ids)
+
+    def delete(self, request_ids: list[int]):
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany(
+                "DELETE FROM results WHERE RequestID = ?", [(request_id,) for request_id in request_ids]
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    async def load(self, request_ids: list[int]) -> dict:
+        """Возвращает результаты: RequestID -> (IsError, Response)"""
+        return await self.run(self.select, request_ids)
+
+    def select(self, request_ids: list[int]) -> dict:
+        results = {}
+        for i in range(0, len(request_ids), 500):
+            chunk = request_ids[i : i + 500]
+            rows = self.db.execute(
+                f"SELECT RequestID, IsError, Response FROM results WHERE RequestID IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            results.update((request_id, (is_error, text)) for request_id, is_error, text in rows)
+        return results
+
+    async def pending(self, limit: int, after: int = -1) -> list[tuple]:
+        """Результаты (RequestID, IsError, Response, TypeID) с номером больше after по возрастанию номера"""
+        return await self.run(
+            lambda: self.db.execute(
+                "SELECT RequestID, IsError, Response, TypeID FROM results WHERE RequestID > ? "
+                "ORDER BY RequestID LIMIT ?",
+                (after, limit),
+            ).fetchall()
+        )
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.ids),
+            "added": self.added,
+            "removed": self.removed,
+            "commits": self.commits,
+        }
@@ -0,0 +1,49 @@
+import asyncio
+
+from breaker import CLOSED, HALF_OPEN, CircuitBreaker
+
+
+def half_open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker({"outage": 1}, open_time=0)
+    breaker.on_failure("outage")
+    return breaker
+
+
+async def send(breaker: CircuitBreaker, exception: Exception = None):
+    """Запрос воркера: пробный запрос освобождается в finally, если его исход не дошёл до автомата"""
+    probe = await breaker.acquire()
+    try:
+        if exception is not None:
+            raise exception
+        breaker.on_success()
+    except Exception:
+        pass
+    finally:
+        breaker.release(probe)
+
+
+def test_probe_raising_arbitrary_exception_lets_next_probe_through():
+    async def run():
+        breaker = half_open_breaker()
+        await send(breaker, RuntimeError("unexpected"))
+        assert breaker.state == HALF_OPEN
+        await asyncio.wait_for(send(breaker), 1)
+        assert breaker.state == CLOSED
+
+    asyncio.run(run())
+
+
+def test_stale_release_keeps_current_probe():
+    async def run():
+        breaker = half_open_breaker()
+        probe = await breaker.acquire()
+        breaker.on_failure("outage")
+        current = await breaker.acquire()
+        breaker.release(probe)
+        waiting = asyncio.create_task(breaker.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        breaker.release(current)
+        assert await asyncio.wait_for(waiting, 1) is not None
+
+    asyncio.run(run())
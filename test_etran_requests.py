@@ -0,0 +1,24 @@
+import pytest
+
+import etran_requests
+import etran_samples
+
+wagons = ["50000001", "50000002", "50000003"]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("request_type", [2, 4, 6])
+def test_split_part_matches_single_request(request_type, stream):
+    merged = etran_samples.make_response(request_type, wagons, fields=2)
+    wagon_sets = [{int(wagons[0]), int(wagons[2])}, {int(wagons[1])}]
+    parts = etran_requests.decode_wagon_response(merged, wagon_sets, stream).parts
+
+    decode = etran_requests.decode_response_stream if stream else etran_requests.decode_response
+    for part, wagon_set in zip(parts, wagon_sets):
+        single = etran_samples.make_response(request_type, [str(wagon) for wagon in sorted(wagon_set)], fields=2)
+        assert part == decode(single).text
+
+
+def test_unmatched_child_is_not_copied_into_parts():
+    text = "<root>\n<vagon><nom>50000001</nom></vagon>\n<vagon><nom>50000002</nom></vagon>\n<note>x</note></root>"
+    assert etran_requests.split_wagon_response(text, [{50000001}, {50000002}]) is None
@@ -0,0 +1,53 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+from scheduler import FairQueue
+from tracing import Trace
+
+created = itertools.count(1)
+
+
+def packet(request_id: int, priority: int = 0, request_type: int = 2):
+    return SimpleNamespace(
+        request_id=request_id, priority=priority, request_type=request_type, created=next(created), trace=Trace()
+    )
+
+
+def fair_queue(aging: float = 0) -> FairQueue:
+    return FairQueue(0, {}, {}, {}, aging)
+
+
+async def drain(queue: FairQueue) -> list[int]:
+    ids = []
+    while queue.qsize():
+        request_packet = await queue.get()
+        queue.task_done(request_packet)
+        ids.append(request_packet.request_id)
+    return ids
+
+
+def test_requeued_packet_keeps_its_place_without_aging():
+    async def run():
+        queue = fair_queue()
+        packets = [packet(i) for i in range(1, 5)]
+        for request_packet in packets:
+            queue.put_nowait(request_packet)
+
+        # первый запрос взят воркером и возвращён после отказа в обслуживании
+        first = await queue.get()
+        queue.task_done(first)
+        queue.put_nowait(first)
+        return await drain(queue)
+
+    assert asyncio.run(run()) == [1, 2, 3, 4]
+
+
+def test_priority_comes_before_arrival_order():
+    async def run():
+        queue = fair_queue()
+        for request_packet in (packet(1, priority=2), packet(2, priority=1), packet(3, priority=1)):
+            queue.put_nowait(request_packet)
+        return await drain(queue)
+
+    assert asyncio.run(run()) == [2, 3, 1]
@@ -0,0 +1,95 @@
+import collections
+import json
+import logging
+import time
+
+# разница между временем time.time() и time.monotonic() для перевода отметок в абсолютное время
+_WALL_OFFSET = time.time() - time.monotonic()
+
+
+class Trace:
+    """Отметки этапов жизни запроса по time.monotonic()
+
+    Каждая отметка - начало этапа, этап длится до следующей отметки: intake, batch, merged, queue_in, etran,
+    queue_out, decode, retry_wait, queue_db, db_write, done. Повторы дополнительно записываются в retries
+    с причиной.
+    """
+
+    def __init__(self, stage: str = "intake"):
+        self.marks = []
+        self.retries = []
+        self.mark(stage)
+
+    def mark(self, stage: str):
+        self.marks.append((stage, time.monotonic()))
+
+    def retry(self, reason: str):
+        self.retries.append((reason, time.monotonic()))
+        self.mark("retry_wait")
+
+    def absorb(self, other: "Trace"):
+        """Дополняет трассу исходного запроса трассой объединённого запроса, в который он входил"""
+        self.marks.extend(other.marks)
+        self.retries.extend(other.retries)
+
+    def spans(self) -> list[tuple]:
+        """Этапы: (имя, начало, конец)"""
+        return [(stage, start, end) for (stage, start), (_, end) in zip(self.marks, self.marks[1:])]
+
+    def duration(self) -> float:
+        return self.marks[-1][1] - self.marks[0][1]
+
+
+class TraceSink:
+    """Приёмник завершённых трасс: файл JSON lines и журнал медленных запросов
+
+    Строка файла - трасса одного запроса в виде span'ов в духе OpenTelemetry (время в наносекундах Unix),
+    которые сборщик может читать из файла. Запрос, выполнявшийся дольше slow[тип] (или slow_default) секунд,
+    записывается в журнал с разбивкой времени по этапам.
+    """
+
+    def __init__(self, path: str = None, slow: dict = None, slow_default: float = None):
+        self.file = open(path, "a", encoding="utf8", buffering=1) if path else None
+        self.slow = slow or {}
+        self.slow_default = slow_default
+        self.counters = collections.Counter()
+
+    def finish(self, request_id: int, request_type: int, trace: Trace):
+        trace.mark("done")
+        duration = trace.duration()
+        self.counters["finished"] += 1
+
+        if (threshold := self.slow.get(request_type, self.slow_default)) is not None and duration > threshold:
+            self.counters["slow"] += 1
+            stages = collections.Counter()
+            for stage, start, end in trace.spans():
+                stages[stage] += end - start
+            logging.warning(
+                f"slow request id={request_id} type={request_type} {duration:.3f}s "
+                + " ".join(f"{stage}={seconds:.3f}s" for stage, seconds in stages.items())
+                + (f" retries={','.join(reason for reason, _ in trace.retries)}" if trace.retries else "")
+            )
+
+        if self.file is not None:
+            record = {
+                "trace_id": f"{request_id:032x}",
+                "request_id": request_id,
+                "type": request_type,
+                "duration": round(duration, 6),
+                "retries": [
+                    {"reason": reason, "time_unix_nano": int((at + _WALL_OFFSET) * 1e9)} for reason, at in trace.retries
+                ],
+                "spans": [
+                    {
+                        "name": stage,
+                        "start_time_unix_nano": int((start + _WALL_OFFSET) * 1e9),
+                        "end_time_unix_nano": int((end + _WALL_OFFSET) * 1e9),
+                    }
+                    for stage, start, end in trace.spans()
+                ],
+            }
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
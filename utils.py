@@ -1,5 +1,8 @@
 import asyncio
+import heapq
+import itertools
 import logging
+import time
 
 
 class CancellableSleep:
@@ -27,6 +30,42 @@ class CancellableSleep:
             t.cancel()
 
 
+class DelayQueue:
+    """Отложенные элементы, каждый из которых выпускается в целевую очередь не раньше своего срока"""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, item, delay: float):
+        heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), item))
+        self.wakeup.set()
+
+    def snapshot(self) -> list:
+        """Возвращает пары (секунд до выпуска, элемент) в порядке выпуска"""
+        now = time.monotonic()
+        return [(not_before - now, item) for not_before, _, item in sorted(self.heap)]
+
+    async def run(self, queue: asyncio.Queue):
+        """Выпускает в queue элементы, срок которых наступил"""
+        while True:
+            self.wakeup.clear()
+            while self.heap and self.heap[0][0] <= time.monotonic():
+                _, _, item = heapq.heappop(self.heap)
+                await queue.put(item)
+
+            # спим до ближайшего срока или до появления нового элемента
+            timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
 class RerunMeException(Exception):
     pass
 
@@ -44,6 +83,23 @@ async def rerun_on_exception(coro, *args, sleep_for=0, **kwargs):
                 await asyncio.sleep(sleep_for)
 
 
+async def get_batch(queue: asyncio.Queue, max_size: int, timeout: float) -> list:
+    """Дожидается первого элемента очереди и добирает к нему до max_size элементов в течение timeout секунд"""
+    batch = [await queue.get()]
+    deadline = asyncio.get_running_loop().time() + timeout
+    while len(batch) < max_size:
+        if not queue.empty():
+            batch.append(queue.get_nowait())
+        elif (remaining := deadline - asyncio.get_running_loop().time()) > 0:
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        else:
+            break
+    return batch
+
+
 def xml_escape(val: str) -> str:
     return val.replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&apos;")
 